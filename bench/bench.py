@@ -0,0 +1,326 @@
+"""
+Offline load test for the bot.
+
+Drives the real handlers of main.py against local stand-ins:
+  * a fake Bot API server (answers every method, optional latency)
+  * a fake Unsplash server (configurable latency and hourly rate limit)
+  * a local MySQL database, dropped and recreated on every run
+
+N synthetic users send /start and then click through their group's flow
+(wide: category -> subcategory, narrow: category), several users at a time.
+Then the morning broadcast runs for all of them. The report lists p50/p99
+latency per step, updates/sec and broadcast duration, tagged with the git
+commit, so runs can be compared across commits.
+
+    DB_HOST=127.0.0.1 DB_USER=root DB_PASS=... python bench/bench.py --users 500
+
+Only BENCH_DB_NAME (default mvp_wallpapers_bench) is touched; it is wiped
+on every run. Results are also appended to bench_output.txt.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# -------------------------
+# FAKE SERVERS
+# -------------------------
+class FakeServer:
+    """ThreadingHTTPServer on a free local port, run in a daemon thread."""
+
+    def __init__(self, handler_class, **attrs):
+        handler = type(handler_class.__name__, (handler_class,), attrs)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body, headers: Dict[str, str] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeBotApi(JsonHandler):
+    """Enough of the Bot API for the handlers and broadcasts: every call succeeds."""
+
+    calls: Dict[str, int] = {}
+    message_ids = count(1)
+    file_ids = count(1)
+
+    def _params(self) -> Dict[str, str]:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0)).decode(errors="replace")
+        if "multipart/form-data" in self.headers.get("Content-Type", ""):
+            return dict(re.findall(r'name="(\w+)"\r\n\r\n([^\r]*)', body))
+        return {k: v[0] for k, v in parse_qs(body).items()}
+
+    def _message(self, params: Dict[str, str], **extra):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return {"message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, **extra}
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        params = self._params()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "sendPhoto":
+            file_id = f"photo-{next(self.file_ids)}"
+            result = self._message(params, photo=[{"file_id": file_id, "file_unique_id": file_id,
+                                                   "width": 1080, "height": 1920}])
+        elif method == "sendDocument":
+            file_id = f"doc-{next(self.file_ids)}"
+            result = self._message(params, document={"file_id": file_id, "file_unique_id": file_id})
+        elif method.startswith("send") or method.startswith("edit"):
+            result = self._message(params, text=params.get("text", ""))
+        else:
+            result = True
+        self.send_json(200, {"ok": True, "result": result})
+
+
+class FakeUnsplash(JsonHandler):
+    """/photos/random with X-Ratelimit-* headers and a fixed hourly quota."""
+
+    hourly_limit = 50
+    requests = 0
+    photo_ids = count(1)
+    lock = threading.Lock()
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path != "/photos/random":
+            self.send_json(404, {"errors": ["Not found"]})
+            return
+        with self.lock:
+            FakeUnsplash.requests += 1
+            remaining = self.hourly_limit - FakeUnsplash.requests
+        headers = {"X-Ratelimit-Limit": str(self.hourly_limit), "X-Ratelimit-Remaining": str(max(remaining, 0))}
+        if remaining < 0:
+            body = b"Rate Limit Exceeded"
+            self.send_response(403)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        query = parse_qs(url.query)
+        n = int(query.get("count", ["1"])[0])
+        photos = []
+        for _ in range(n):
+            photo_id = f"bench{next(self.photo_ids)}"
+            photos.append({"id": photo_id, "urls": {"regular": f"https://images.example/{photo_id}.jpg"}})
+        self.send_json(200, photos, headers)
+
+
+# -------------------------
+# SYNTHETIC USERS
+# -------------------------
+def user_json(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def start_update(update_id: int, user_id: int) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": "/start",
+        "chat": {"id": user_id, "type": "private"}, "from": user_json(user_id),
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user_json(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "text": "Choose one category:",
+                    "chat": {"id": user_id, "type": "private"}},
+    }}
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Bench:
+    def __init__(self, main, application, concurrency: int):
+        self.main = main
+        self.application = application
+        self.concurrency = concurrency
+        self.update_ids = count(1)
+        self.latencies: Dict[str, List[float]] = {}
+
+    async def send(self, step: str, data: dict):
+        """Process one update the way the update fetcher does and time it end to end."""
+        update = self.main.Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update))
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+
+    async def user_flow(self, user_id: int, rng: random.Random):
+        await self.send("start", start_update(next(self.update_ids), user_id))
+        user = await self.main.run_db(self.main.get_or_create_user, user_id)
+        # Tap the buttons the bot actually sends
+        catalog = self.main.catalog
+        if user["group"] == "wide":
+            [button] = rng.choice(catalog.wide_markup.inline_keyboard)
+            await self.send("wide_menu", callback_update(next(self.update_ids), user_id, button.callback_data))
+            submenu = catalog.submenu(catalog.decode(button.callback_data).key)
+            [button] = rng.choice(submenu.inline_keyboard)
+            await self.send("wallpaper", callback_update(next(self.update_ids), user_id, button.callback_data))
+        else:
+            [button] = rng.choice(catalog.narrow_markup.inline_keyboard)
+            await self.send("wallpaper", callback_update(next(self.update_ids), user_id, button.callback_data))
+
+    async def run_users(self, users: int, seed: int) -> float:
+        rng = random.Random(seed)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(user_id):
+            async with semaphore:
+                await self.user_flow(user_id, rng)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(1000 + i) for i in range(users)))
+        return time.perf_counter() - started
+
+
+# -------------------------
+# RUN
+# -------------------------
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def reset_database(name: str):
+    import mysql.connector
+    conn = mysql.connector.connect(host=os.getenv("DB_HOST", "127.0.0.1"), port=os.getenv("DB_PORT", "3306"),
+                                   user=os.getenv("DB_USER"), password=os.getenv("DB_PASS"))
+    try:
+        c = conn.cursor()
+        c.execute(f"DROP DATABASE IF EXISTS `{name}`")
+        c.execute(f"CREATE DATABASE `{name}` CHARACTER SET utf8mb4")
+        c.close()
+    finally:
+        conn.close()
+
+
+async def run(args) -> List[str]:
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    main.init_db()
+    application = main.build_application()
+    async with application:
+        await main.on_startup(application)
+        bench = Bench(main, application, args.concurrency)
+        users_elapsed = await bench.run_users(args.users, args.seed)
+        total_updates = sum(len(v) for v in bench.latencies.values())
+
+        started = time.perf_counter()
+        await main.run_broadcast(application.bot, "morning_prompt")
+        broadcast_elapsed = time.perf_counter() - started
+        await main.unsplash.close()
+
+    lines = [
+        f"commit={git_commit()} date={datetime.now().isoformat(timespec='seconds')} users={args.users} "
+        f"concurrency={args.concurrency} update_concurrency={main.UPDATE_CONCURRENCY} "
+        f"telegram_latency={args.telegram_latency}s unsplash_latency={args.unsplash_latency}s "
+        f"unsplash_limit={args.unsplash_limit}/h",
+        f"updates: {total_updates} in {users_elapsed:.2f}s = {total_updates / users_elapsed:.1f} updates/s",
+    ]
+    for step, values in bench.latencies.items():
+        lines.append(f"  {step:<10} n={len(values):<6} p50={percentile(values, 0.5) * 1000:8.1f}ms "
+                     f"p99={percentile(values, 0.99) * 1000:8.1f}ms max={max(values) * 1000:8.1f}ms")
+    lines.append(f"morning broadcast: {args.users} users in {broadcast_elapsed:.2f}s "
+                 f"({args.users / broadcast_elapsed:.1f} msg/s)")
+    lines.append(f"unsplash requests: {FakeUnsplash.requests}, bot api calls: "
+                 + ", ".join(f"{k}={v}" for k, v in sorted(FakeBotApi.calls.items())))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="users clicking at the same time")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per Bot API call")
+    parser.add_argument("--unsplash-latency", type=float, default=0.3, help="seconds per Unsplash request")
+    parser.add_argument("--unsplash-limit", type=int, default=50, help="Unsplash requests per hour")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    db_name = os.getenv("BENCH_DB_NAME", "mvp_wallpapers_bench")
+    reset_database(db_name)
+
+    with FakeServer(FakeBotApi, latency=args.telegram_latency) as bot_api, \
+            FakeServer(FakeUnsplash, latency=args.unsplash_latency, hourly_limit=args.unsplash_limit) as unsplash:
+        # main.py reads its configuration on import
+        os.environ.update({
+            "BOT_TOKEN": "123456:bench",
+            "BOT_MODE": "webhook",  # no getUpdates; the bench feeds updates itself
+            "TELEGRAM_API_URL": f"{bot_api.url}/bot",
+            "TELEGRAM_FILE_URL": f"{bot_api.url}/file/bot",
+            "UNSPLASH_ACCESS_KEY": "bench",
+            "UNSPLASH_API_URL": unsplash.url,
+            "UNSPLASH_HOURLY_LIMIT": str(args.unsplash_limit),
+            "DB_NAME": db_name,
+        })
+        for owner in ("BOT_OWNER_ID", "BOT_OWNER_ID2", "BOT_OWNER_ID3"):
+            os.environ.setdefault(owner, "1")
+        sys.path.insert(0, ROOT)
+        lines = asyncio.run(run(args))
+
+    report = "\n".join(lines)
+    print(report)
+    with open(os.path.join(ROOT, "bench_output.txt"), "a") as f:
+        f.write(report + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
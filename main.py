@@ -1,27 +1,50 @@
 import logging
 
+import asyncio
+import bisect
+import contextvars
+import functools
+import io
+import hmac
+import json
 import random
-import requests
+import httpx
 # Removed `import sqlite3`
+import math
 import os
+import signal
+import socket
+import sys
+import threading
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from datetime import time as dt_time
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Callable, NamedTuple, Optional, TypeVar
 import pytz
 
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import PoolError
 
 from dotenv import load_dotenv
+from flask import Flask, Response, abort, jsonify, request
+from werkzeug.serving import make_server
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
@@ -30,7 +53,53 @@ from telegram.ext import (
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Point at a local fake Bot API for testing, e.g. http://127.0.0.1:8081/bot
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+# "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL Telegram posts to
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Serve /metrics on this port in polling mode (webhook mode serves it next to the webhook)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Updates handled at once; updates of the same user always run one at a time
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
 UNSPLASH_ACCESS_KEY = os.getenv("UNSPLASH_ACCESS_KEY")
+UNSPLASH_API_URL = os.getenv("UNSPLASH_API_URL", "https://api.unsplash.com")
+UNSPLASH_HOURLY_LIMIT = int(os.getenv("UNSPLASH_HOURLY_LIMIT", "50"))
+UNSPLASH_MAX_COUNT = 30  # most photos /photos/random returns per request
+# Requests the nightly prefetch must leave untouched for on-demand fetches
+UNSPLASH_USER_RESERVE = int(os.getenv("UNSPLASH_USER_RESERVE", "10"))
+# How long a user click may wait for an Unsplash token before giving up
+UNSPLASH_USER_WAIT = float(os.getenv("UNSPLASH_USER_WAIT", "5"))
+
+# Broadcast settings (Telegram allows ~30 messages/s overall and ~1/s per chat)
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_PER_CHAT_INTERVAL = 1.0
+
+# Multi-replica coordination
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}:{os.getpid()}"
+JOB_LEASE_TTL = int(os.getenv("JOB_LEASE_TTL", "300"))  # seconds, renewed while the job runs
+# Split each broadcast into this many user_id shards that replicas claim independently
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "1"))
+
+# Outbox settings
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BACKOFF_BASE = int(os.getenv("OUTBOX_BACKOFF_BASE", "30"))  # seconds, doubled per attempt
+OUTBOX_BACKOFF_MAX = int(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+OUTBOX_POLL_INTERVAL = int(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+OUTBOX_STALE_AFTER = int(os.getenv("OUTBOX_STALE_AFTER", "300"))  # a "sending" row older than this is retried
+OUTBOX_MAX_AGE_HOURS = int(os.getenv("OUTBOX_MAX_AGE_HOURS", "12"))  # older undelivered messages are dropped
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))  # finished rows are purged after this
+OUTBOX_PURGE_INTERVAL = int(os.getenv("OUTBOX_PURGE_INTERVAL", "3600"))  # seconds between expiry/purge passes
 BOT_OWNER_ID = int(os.getenv("BOT_OWNER_ID"))
 BOT_OWNER_ID2 = int(os.getenv("BOT_OWNER_ID2"))
 BOT_OWNER_ID3 = int(os.getenv("BOT_OWNER_ID3"))
@@ -41,12 +110,61 @@ DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 DB_NAME = os.getenv("DB_NAME")
 
+# Nightly prefetch planner
+PREFETCH_IMAGES_PER_REQUEST = UNSPLASH_MAX_COUNT
+PREFETCH_MAX_REQUESTS = int(os.getenv("PREFETCH_MAX_REQUESTS", "45"))  # Unsplash requests per night
+PREFETCH_DEMAND_DAYS = int(os.getenv("PREFETCH_DEMAND_DAYS", "7"))  # demand look-back window
+PREFETCH_TARGET_DAYS = int(os.getenv("PREFETCH_TARGET_DAYS", "3"))  # unseen images to keep per active user
+PREFETCH_MIN_DEPTH = int(os.getenv("PREFETCH_MIN_DEPTH", "5"))  # images to keep even in idle categories
+PREFETCH_DRY_RUN = os.getenv("PREFETCH_DRY_RUN", "") == "1"
+
+# Minimum time between two wallpapers, per user group
+CATEGORY_LIMIT_WINDOWS = {
+    "narrow": timedelta(hours=float(os.getenv("LIMIT_HOURS_NARROW", "12"))),
+    "wide": timedelta(hours=float(os.getenv("LIMIT_HOURS_WIDE", "12"))),
+}
+DEFAULT_LIMIT_WINDOW = timedelta(hours=12)
+
+# In-process user cache
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # seconds
+
+# Seen-image index
+SEEN_CACHE_BYTES = int(os.getenv("SEEN_CACHE_MB", "64")) * 1024 * 1024  # in-memory per-user seen sets
+CATEGORY_BITMAP_TTL = int(os.getenv("CATEGORY_BITMAP_TTL", "300"))  # seconds before reloading a category
+
+# In-memory ready pool of images per category
+READY_LOW_WATER = int(os.getenv("READY_LOW_WATER", "5"))  # unseen images left for a user before a background refill
+READY_POOL_MAX = int(os.getenv("READY_POOL_MAX", "5000"))  # newest images kept per category
+READY_REFRESH_INTERVAL = int(os.getenv("READY_REFRESH_INTERVAL", "60"))  # seconds between pool top-ups from MySQL
+
+# Categories and their keyboards come from the `categories` table
+CATALOG_RELOAD_INTERVAL = int(os.getenv("CATALOG_RELOAD_INTERVAL", "60"))  # seconds between checks for edits
+
+# Speculative warming when a wide-group user opens a category menu
+SPECULATE_TOP = int(os.getenv("SPECULATE_TOP", "2"))  # most-picked subcategories to warm
+SPECULATE_TTL = int(os.getenv("SPECULATE_TTL", "600"))  # seconds a warmed menu waits for a tap
+SPECULATE_UNSPLASH_PER_HOUR = int(os.getenv("SPECULATE_UNSPLASH_PER_HOUR", "5"))  # Unsplash requests speculation may spend
+WARMUP_CHAT_ID = int(os.getenv("WARMUP_CHAT_ID", "0"))  # chat to pre-upload images to; 0 disables
+
+# /profile command
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.01"))  # seconds between stack samples
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))  # reconnect connections older than this
+DB_POOL_PING_AFTER = int(os.getenv("DB_POOL_PING_AFTER", "30"))  # ping connections idle longer than this
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 cyprus_tz = pytz.timezone("Asia/Nicosia")
 
-# Example categories...
+# Built-in categories; they seed the `categories` table on first run, which is
+# where categories are managed from then on (see CATEGORY CATALOG).
 wide_categories = {
     "Nature": ["Mountains", "Forests", "Beaches", "Sunsets", "Rivers", "Waterfalls", "Deserts", "Caves"],
     "Space": ["Galaxies", "Planets", "Nebulae", "Stars", "Black Holes"],
@@ -61,224 +179,2816 @@ wide_categories = {
 }
 narrow_categories = ["Nature", "Abstract", "Animals", "Space", "Cities", "Fantasy", "Technology"]
 
+USAGE_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Yes", callback_data="used:yes"),
+        InlineKeyboardButton("No", callback_data="used:no"),
+    ]
+])
+
+
+def usage_markup(event_id: int) -> InlineKeyboardMarkup:
+    """Usage question about one delivery; the answer is recorded against it."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Yes", callback_data=f"used:yes:{event_id}"),
+            InlineKeyboardButton("No", callback_data=f"used:no:{event_id}"),
+        ]
+    ])
+
+
+# -------------------------
+# CATEGORY CATALOG
+# -------------------------
+class CategoryEntry(NamedTuple):
+    id: int
+    kind: str  # "wide" (opens a submenu), "sub" (wide subcategory) or "narrow"
+    key: str  # category_key used for images, e.g. "Nature:Mountains"
+    name: str
+    callback_data: str
+
+
+# Prefix of compact callback_data: format version + kind initial, e.g. "c1s42"
+CALLBACK_VERSION = "c1"
+# callback_data of keyboards sent before the catalog, still accepted
+LEGACY_CALLBACK_PREFIXES = {"wide": "cat:", "sub": "subcat:", "narrow": "narrow_cat:"}
+
+
+class CategoryCatalog:
+    """
+    Immutable snapshot of the `categories` table with every keyboard
+    prebuilt. Buttons carry compact callback_data ("c1" + kind initial +
+    row id) that decode() maps back to its entry with one dict lookup.
+    Row ids are stable, so keyboards sent before a reload keep working
+    unless their category was deactivated. A reload builds a new catalog
+    and swaps the module-level `catalog`.
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]], version: int = 0):
+        self.version = version
+        self.wide: Dict[str, List[str]] = {}  # category -> its subcategory keys, in menu order
+        self.narrow: List[str] = []
+        self._by_callback: Dict[str, CategoryEntry] = {}
+        self._submenus: Dict[str, InlineKeyboardMarkup] = {}
+        wide_buttons, narrow_buttons, sub_buttons = [], [], {}
+
+        # Categories before subcategories, so a subcategory can check its parent
+        for row in sorted(rows, key=lambda r: (r["parent_key"] is not None, r["position"], r["id"])):
+            if row["user_group"] == "narrow":
+                kind = "narrow"
+            elif row["parent_key"] is None:
+                kind = "wide"
+            elif row["parent_key"] in self.wide:
+                kind = "sub"
+            else:
+                continue  # parent missing or inactive: unreachable
+            entry = CategoryEntry(row["id"], kind, row["category_key"], row["name"],
+                                  f"{CALLBACK_VERSION}{kind[0]}{row['id']}")
+            self._by_callback[entry.callback_data] = entry
+            self._by_callback[LEGACY_CALLBACK_PREFIXES[kind] + entry.key] = entry
+            button = [InlineKeyboardButton(entry.name, callback_data=entry.callback_data)]
+            if kind == "narrow":
+                self.narrow.append(entry.key)
+                narrow_buttons.append(button)
+            elif kind == "wide":
+                self.wide.setdefault(entry.key, [])
+                wide_buttons.append(button)
+            else:
+                sub_buttons.setdefault(row["parent_key"], []).append(button)
+                self.wide[row["parent_key"]].append(entry.key)
+
+        self.wide_markup = InlineKeyboardMarkup(wide_buttons)
+        self.narrow_markup = InlineKeyboardMarkup(narrow_buttons)
+        for parent, buttons in sub_buttons.items():
+            self._submenus[parent] = InlineKeyboardMarkup(buttons)
+
+    def decode(self, callback_data: str) -> Optional[CategoryEntry]:
+        return self._by_callback.get(callback_data)
+
+    def submenu(self, category: str) -> Optional[InlineKeyboardMarkup]:
+        return self._submenus.get(category) if category in self.wide else None
+
+    def category_keys(self) -> List[str]:
+        """Every category_key a user can pick: narrow categories and wide subcategories."""
+        keys = list(self.narrow)
+        for subcats in self.wide.values():
+            keys.extend(subcats)
+        return keys
+
+
+# Empty until refresh_catalog() runs at startup
+catalog = CategoryCatalog([])
+
+
+def refresh_catalog(rows: List[Dict[str, Any]]) -> bool:
+    """Swap in a new catalog if the categories table changed. Returns True if it did."""
+    global catalog
+    version = zlib.crc32(repr(rows).encode())
+    if version == catalog.version:
+        return False
+    catalog = CategoryCatalog(rows, version)
+    logger.info(f"Category catalog loaded: {len(catalog.wide)} wide, {len(catalog.narrow)} narrow categories")
+    return True
+
+
+# Outbox payloads refer to markups by name; resolved at send time, so a
+# broadcast queued before a catalog reload sends the current keyboard
+OUTBOX_MARKUPS = {
+    "wide_categories": lambda: catalog.wide_markup,
+    "narrow_categories": lambda: catalog.narrow_markup,
+    "usage": lambda: USAGE_MARKUP,
+}
+
+# -------------------------
+# CONNECTION POOL
+# -------------------------
+class PooledConnection:
+    """
+    Thin proxy around a MySQL connection. Everything is delegated to the real
+    connection except close(), which hands the connection back to the pool.
+    """
+
+    def __init__(self, pool: "ConnectionPool", conn, created_at: float):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn, self._created_at)
+
+
+class ConnectionPool:
+    """
+    Fixed-size MySQL connection pool.
+
+    Connections are opened lazily up to `size`. Callers that find the pool
+    exhausted wait up to `timeout` seconds. Connections older than `recycle`
+    seconds are reopened, and connections idle for more than `ping_after`
+    seconds are pinged before being handed out.
+    """
+
+    def __init__(self, size: int, timeout: float, recycle: int, ping_after: int, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._connect_args = connect_args
+        self._idle = deque()  # (conn, created_at, last_used)
+        self._cond = threading.Condition()
+        self._open = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._created = 0
+        self._recycled = 0
+        self._timeouts = 0
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self._connect_args)
+        with self._cond:
+            self._created += 1
+        return conn, time.monotonic()
+
+    def _is_healthy(self, conn, created_at: float, last_used: float) -> bool:
+        now = time.monotonic()
+        if now - created_at > self.recycle:
+            return False
+        if now - last_used > self.ping_after:
+            try:
+                conn.ping(reconnect=False)
+            except Error:
+                return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    self._in_use += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolError(f"No free MySQL connection after {self.timeout}s (pool size {self.size})")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        # Connecting / pinging happens outside the lock
+        try:
+            if conn is not None and not self._is_healthy(conn, created_at, last_used):
+                self._discard(conn)
+                with self._cond:
+                    self._recycled += 1
+                conn = None
+            if conn is None:
+                conn, created_at = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, conn, created_at)
+
+    def release(self, conn, created_at: float):
+        healthy = True
+        try:
+            # Never leak an unfinished transaction to the next borrower
+            if conn.in_transaction:
+                conn.rollback()
+        except Error:
+            healthy = False
+        with self._cond:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append((conn, created_at, time.monotonic()))
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if not healthy:
+            self._discard(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "created": self._created,
+                "recycled": self._recycled,
+                "timeouts": self._timeouts,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    size=DB_POOL_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    recycle=DB_POOL_RECYCLE,
+                    ping_after=DB_POOL_PING_AFTER,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    user=DB_USER,
+                    password=DB_PASS,
+                    database=DB_NAME
+                )
+    return _pool
+
+
+def pool_stats() -> Dict[str, int]:
+    """Current pool usage: open/in_use/idle/waiting connections and lifetime counters."""
+    return get_pool().stats()
+
+
 def get_connection():
+    """Borrow a connection from the pool. conn.close() returns it to the pool."""
     try:
-        conn = mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        return conn
+        return get_pool().acquire()
     except Error as e:
         logger.error(f"Error connecting to MySQL: {e}")
         raise
 
-def init_db():
+
+# -------------------------
+# METRICS
+# -------------------------
+# Latency buckets in seconds, from a cached DB read to a slow upload
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_str(labels: tuple) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels)
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                label_str = _label_str(tuple(zip(self.labelnames, labels)))
+                lines.append(f"{self.name}{{{label_str}}} {value}" if label_str else f"{self.name} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus histogram with fixed buckets. observe() is a bisect and a
+    few additions under a lock, cheap enough for every DB call and send.
+    """
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: Dict[tuple, List] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                base = tuple(zip(self.labelnames, labels))
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{{{_label_str(base + (('le', bound),))}}} {cumulative}")
+                lines.append(f"{self.name}_bucket{{{_label_str(base + (('le', '+Inf'),))}}} {series[-1]}")
+                suffix = f"{{{_label_str(base)}}}" if base else ""
+                lines.append(f"{self.name}_sum{suffix} {series[-2]}")
+                lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms recorded on the hot path, plus gauges read
+    from the existing stats (pool, caches, quota) only when scraped.
+    """
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._gauges: List[tuple] = []  # (name, doc, fn returning a number or {label: number}, label name)
+
+    def counter(self, name: str, doc: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, doc, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, doc, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, doc: str, fn: Callable[[], Any], labelname: str = ""):
+        self._gauges.append((name, doc, fn, labelname))
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        for name, doc, fn, labelname in self._gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                logger.warning(f"Metric {name} failed: {e}")
+                continue
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                for label, v in value.items():
+                    lines.append(f'{name}{{{labelname}="{label}"}} {float(v)}')
+            else:
+                lines.append(f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+db_seconds = metrics.histogram("wallpapers_db_seconds", "DB helper latency", ("helper",))
+db_errors = metrics.counter("wallpapers_db_errors_total", "DB helper exceptions", ("helper",))
+unsplash_seconds = metrics.histogram("wallpapers_unsplash_seconds", "Unsplash fetch latency, incl. quota wait")
+unsplash_requests = metrics.counter("wallpapers_unsplash_requests_total", "Unsplash responses by status", ("status",))
+telegram_seconds = metrics.histogram("wallpapers_telegram_seconds", "Bot API call latency", ("method",))
+telegram_errors = metrics.counter("wallpapers_telegram_errors_total",
+                                  "Failed Bot API calls (network error or non-2xx)", ("method",))
+job_seconds = metrics.histogram("wallpapers_job_seconds", "Scheduled job duration", ("job",),
+                                buckets=(1, 5, 15, 60, 300, 900, 1800, 3600))
+job_errors = metrics.counter("wallpapers_job_errors_total", "Scheduled jobs that raised", ("job",))
+ready_refill_seconds = metrics.histogram("wallpapers_ready_refill_seconds",
+                                        "Background ready pool refill: Unsplash fetch + reload")
+speculation_actions = metrics.counter("wallpapers_speculation_actions_total",
+                                      "Speculative warming per subcategory: pooled, fetched, uploaded, over_budget",
+                                      ("action",))
+speculation_outcomes = metrics.counter("wallpapers_speculation_outcomes_total",
+                                       "Subcategory taps vs. warmed menus: hit, miss, unwarmed, expired",
+                                       ("outcome",))
+speculation_cost = metrics.counter("wallpapers_speculation_cost_total",
+                                   "Unsplash requests and uploads spent on speculation, used or wasted",
+                                   ("kind", "result"))
+update_seconds = metrics.histogram("wallpapers_update_seconds", "Update handling time, excl. queueing")
+update_wait_seconds = metrics.histogram("wallpapers_update_wait_seconds", "Time an update waited to start")
+
+
+def timed_job(callback):
+    """Record the duration and failures of a scheduled job."""
+    @functools.wraps(callback)
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        try:
+            with job_seconds.time(callback.__name__), tracer.span(f"job:{callback.__name__}"):
+                await callback(context)
+        except Exception:
+            job_errors.inc(callback.__name__)
+            raise
+    return job
+
+
+class TelegramRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call, labelled by method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            with tracer.span(f"telegram:{api_method}"):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            telegram_errors.inc(api_method)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - started, api_method)
+        if not 200 <= code < 300:
+            telegram_errors.inc(api_method)
+        return code, payload
+
+
+# -------------------------
+# PROFILING
+# -------------------------
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """
+    Span tracing for updates and jobs, only while a profile is running.
+    Spans nest through a contextvar: an update or job is a root span and
+    the DB helpers, Bot API calls and Unsplash fetches it awaits are
+    recorded as its children. When inactive, span() is a flag check.
+    """
+
+    def __init__(self, max_roots: int = 20000):
+        self.active = False
+        self.max_roots = max_roots
+        self.roots: List[Dict[str, Any]] = []
+
+    def start(self):
+        self.roots = []
+        self.active = True
+
+    def stop(self) -> List[Dict[str, Any]]:
+        self.active = False
+        return self.roots
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.active:
+            yield
+            return
+        parent = _current_span.get()
+        span = {"name": name, "start": time.time(), "duration": 0.0, "children": []}
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            span["duration"] = time.perf_counter() - started
+            _current_span.reset(token)
+            if parent is not None:
+                parent["children"].append(span)
+            elif len(self.roots) < self.max_roots:
+                self.roots.append(span)
+
+
+tracer = Tracer()
+
+
+def background_task(name: str, coro) -> asyncio.Task:
+    """
+    Start `coro` as its own root span ("task:<name>"). A task copies the
+    creating handler's context, so without a fresh one its time would land
+    in the handler's span, which has usually finished by then.
+    """
+    async def run():
+        with tracer.span(f"task:{name}"):
+            return await coro
+    return asyncio.create_task(run(), context=contextvars.Context())
+
+
+class SamplingProfiler:
+    """
+    Samples every thread's Python stack with sys._current_frames() each
+    `interval` seconds from a background thread and counts identical
+    stacks. folded() returns them in the "frame;frame;frame count" format
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        self._stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.samples = 0
+        self._stacks = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ";".join([names.get(thread_id, str(thread_id))] + stack[::-1])
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+
+
+profiler = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
+
+
+def update_span_name(update: object) -> str:
+    if isinstance(update, Update):
+        if update.callback_query and update.callback_query.data:
+            entry = catalog.decode(update.callback_query.data)
+            if entry is not None:
+                return "callback:" + entry.kind
+            return "callback:" + update.callback_query.data.split(":", 1)[0]
+        if update.message and update.message.text and update.message.text.startswith("/"):
+            return "command:" + update.message.text.split()[0]
+    return "update"
+
+
+def format_slow_spans(roots: List[Dict[str, Any]], top: int = 10) -> str:
+    """The slowest root spans, each with where its time went (children summed by name)."""
+    lines = []
+    for span in sorted(roots, key=lambda s: -s["duration"])[:top]:
+        started = datetime.fromtimestamp(span["start"], cyprus_tz).strftime("%H:%M:%S")
+        lines.append(f"{span['duration'] * 1000:.0f}ms {span['name']} at {started}")
+        totals: Dict[str, List[float]] = {}
+        for child in span["children"]:
+            entry = totals.setdefault(child["name"], [0, 0.0])
+            entry[0] += 1
+            entry[1] += child["duration"]
+        for name, (calls, spent) in sorted(totals.items(), key=lambda t: -t[1][1])[:5]:
+            lines.append(f"    {spent * 1000:.0f}ms {name} x{calls}")
+    return "\n".join(lines) or "No spans recorded."
+
+
+async def run_profile(bot, chat_id: int, seconds: int):
+    """Let the started profile run for `seconds`, then send the results to chat_id."""
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        roots = tracer.stop()
+        await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+    folded = profiler.folded()
+    await bot.send_document(
+        chat_id=chat_id,
+        document=io.BytesIO(folded.encode()),
+        filename=f"profile-{datetime.now(cyprus_tz):%Y%m%d-%H%M%S}.folded",
+        caption=f"{profiler.samples} samples over {seconds}s, {len(roots)} updates/jobs traced"
+    )
+    await bot.send_message(chat_id=chat_id, text="Slowest spans:\n" + format_slow_spans(roots))
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [seconds] - owners only: sample stacks and trace spans, then send the results."""
+    user_id = update.effective_user.id
+    if user_id not in (BOT_OWNER_ID, BOT_OWNER_ID2, BOT_OWNER_ID3):
+        return
+    if profiler.running:
+        await update.message.reply_text("A profile is already running.")
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("Usage: /profile [seconds]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    profiler.start()
+    tracer.start()
+    await update.message.reply_text(f"Profiling for {seconds}s...")
+    # Don't hold this user's update lock for the whole run
+    context.application.create_task(run_profile(context.bot, update.effective_chat.id, seconds))
+
+
+# -------------------------
+# ASYNC DB ACCESS
+# -------------------------
+# mysql.connector is blocking, so handlers run the DB helpers on a dedicated
+# executor. One worker per pooled connection: a worker never waits on the pool.
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+T = TypeVar("T")
+
+
+def _timed_db_call(func: Callable[..., T], args: tuple) -> T:
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    except Exception:
+        db_errors.inc(func.__name__)
+        raise
+    finally:
+        db_seconds.observe(time.perf_counter() - started, func.__name__)
+
+
+async def run_db(func: Callable[..., T], *args) -> T:
+    """Run a blocking DB helper without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    with tracer.span(f"db:{func.__name__}"):
+        return await loop.run_in_executor(_db_executor, _timed_db_call, func, args)
+
+# -------------------------
+# USER CACHE
+# -------------------------
+class UserCache:
+    """
+    LRU cache of user rows with a TTL, keyed by user_id.
+
+    The DB helpers write through it, so a user is read from MySQL at most
+    once per TTL. Entries are copied in and out: callers can mutate what
+    they get without touching the cache. Thread-safe, since the helpers
+    run on the DB executor.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id -> (expires_at, user)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, user: Dict[str, Any]):
+        with self._lock:
+            self._data[user["user_id"]] = (time.monotonic() + self.ttl, dict(user))
+            self._data.move_to_end(user["user_id"])
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        """Patch a cached user in place (no-op if not cached)."""
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def increment(self, user_id: int, field: str, amount: int = 1):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None:
+                entry[1][field] += amount
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# -------------------------
+# SEEN IMAGE BITMAPS
+# -------------------------
+# Sets of images.id as Python ints: bit n is set when image n is in the set.
+# This is the stored format (user_seen_bitmaps); in memory, sets are kept as
+# sorted arrays of ids instead, which cost 4 bytes per member rather than a
+# bit for every id up to the highest one.
+def bitmap_from_refs(refs) -> int:
+    refs = list(refs)
+    if not refs:
+        return 0
+    raw = bytearray(max(refs) // 8 + 1)
+    for ref in refs:
+        raw[ref >> 3] |= 1 << (ref & 7)
+    return int.from_bytes(raw, "little")
+
+
+def refs_from_bitmap(bits: int) -> List[int]:
+    digits = bin(bits)[:1:-1]  # bit 0 first
+    refs, ref = [], digits.find("1")
+    while ref != -1:
+        refs.append(ref)
+        ref = digits.find("1", ref + 1)
+    return refs
+
+
+def encode_bitmap(bits: int) -> bytes:
+    return zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+
+
+def decode_bitmap(blob: bytes) -> int:
+    return int.from_bytes(zlib.decompress(blob), "little")
+
+
+def sorted_refs(refs) -> array:
+    return array("I", sorted(set(refs)))
+
+
+class SeenSet:
+    """
+    The images.id values a user has seen, as a sorted array: memory grows
+    with the images the user received (about one a day), not with the
+    highest id in the catalog. Immutable, so cached sets can be shared
+    between threads; with_ref() returns a new one.
+    """
+
+    __slots__ = ("refs",)
+
+    def __init__(self, refs=()):
+        self.refs = sorted_refs(refs)
+
+    def __contains__(self, ref: int) -> bool:
+        i = bisect.bisect_left(self.refs, ref)
+        return i < len(self.refs) and self.refs[i] == ref
+
+    def __len__(self) -> int:
+        return len(self.refs)
+
+    def with_ref(self, ref: int) -> "SeenSet":
+        if ref in self:
+            return self
+        seen = SeenSet()
+        seen.refs = array("I", self.refs)
+        bisect.insort(seen.refs, ref)
+        return seen
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.refs) * self.refs.itemsize
+
+
+def lowest_unseen(refs: array, seen: SeenSet, limit: int) -> List[int]:
+    """The first `limit` of the sorted `refs` that are not in `seen`."""
+    unseen = []
+    for ref in refs:
+        if ref not in seen:
+            unseen.append(ref)
+            if len(unseen) == limit:
+                break
+    return unseen
+
+
+class SeenIndex:
+    """
+    Picks unseen images without an anti-join against user_images: walk the
+    category's ids in order and skip the ones in the user's SeenSet, so a
+    pick costs the user's seen images in that category, not the catalog.
+
+    Per-user seen sets are stored as bitmaps in user_seen_bitmaps (kept
+    current by record_wallpaper_delivery) and cached in an LRU bounded to
+    `max_bytes`, reread after `ttl` seconds in case another replica
+    delivered meanwhile. Category ids come from image_categories and are
+    reloaded after `category_ttl` seconds, so images ingested by other
+    replicas show up; images added while a category is loading are merged
+    into the loaded copy. Loads run on the caller's connection (the helpers
+    run on the DB executor, which must not take a second pooled connection).
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, category_ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.category_ttl = category_ttl
+        self._users = OrderedDict()  # user_id -> (expires_at, SeenSet)
+        self._bytes = 0
+        self._categories: Dict[str, tuple] = {}  # category_key -> (loaded_at, sorted array of images.id)
+        self._loading: Dict[str, List] = {}  # category_key -> [loads in flight, ids added meanwhile]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(seen: SeenSet) -> int:
+        return seen.nbytes + 64  # + rough per-entry overhead
+
+    def _store_user(self, user_id: int, seen: SeenSet, expires_at: Optional[float] = None):
+        old = self._users.pop(user_id, None)
+        if old is not None:
+            self._bytes -= self._size(old[1])
+        self._users[user_id] = (expires_at or time.monotonic() + self.ttl, seen)
+        self._bytes += self._size(seen)
+        while self._bytes > self.max_bytes and len(self._users) > 1:
+            _, (_, evicted) = self._users.popitem(last=False)
+            self._bytes -= self._size(evicted)
+
+    def cached(self, user_id: int, count: bool = True) -> Optional[SeenSet]:
+        """
+        The user's seen set if it is in memory and fresh, else None. Pass
+        count=False for a lookup the caller has already counted as a miss.
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += count
+                return None
+            self._users.move_to_end(user_id)
+            self.hits += count
+            return entry[1]
+
+    def user(self, conn, user_id: int, count: bool = True) -> SeenSet:
+        seen = self.cached(user_id, count)
+        if seen is not None:
+            return seen
+        seen = load_seen_refs(conn, user_id)
+        with self._lock:
+            self._store_user(user_id, seen)
+        return seen
+
+    def category(self, conn, category_key: str) -> array:
+        with self._lock:
+            entry = self._categories.get(category_key)
+            if entry is not None and time.monotonic() - entry[0] <= self.category_ttl:
+                return entry[1]
+            self._loading.setdefault(category_key, [0, []])[0] += 1
+        loaded_at = time.monotonic()
+        refs = None
+        try:
+            refs = load_category_refs(conn, category_key)
+        finally:
+            with self._lock:
+                loading = self._loading[category_key]
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[category_key]
+                if refs is not None:
+                    if loading[1]:
+                        # Ingested after our SELECT started
+                        refs = sorted_refs([*refs, *loading[1]])
+                    self._categories[category_key] = (loaded_at, refs)
+        return refs
+
+    def unseen(self, conn, category_key: str, user_id: int, limit: int) -> List[int]:
+        """Lowest `limit` image ids of the category the user has not seen."""
+        return lowest_unseen(self.category(conn, category_key), self.user(conn, user_id), limit)
+
+    def mark_seen(self, user_id: int, image_ref: int):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._store_user(user_id, entry[1].with_ref(image_ref), entry[0])
+
+    def add_to_category(self, category_keys: List[str], image_refs: List[int]):
+        with self._lock:
+            for key in category_keys:
+                entry = self._categories.get(key)
+                if entry is not None:
+                    self._categories[key] = (entry[0], sorted_refs([*entry[1], *image_refs]))
+                if key in self._loading:
+                    self._loading[key][1].extend(image_refs)
+
+    def invalidate(self, user_id: int, category_key: Optional[str] = None):
+        with self._lock:
+            entry = self._users.pop(user_id, None)
+            if entry is not None:
+                self._bytes -= self._size(entry[1])
+            if category_key is not None:
+                self._categories.pop(category_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._bytes = 0
+            self._categories.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._users),
+                "bytes": self._bytes,
+                "categories": len(self._categories),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+seen_index = SeenIndex(SEEN_CACHE_BYTES, USER_CACHE_TTL, CATEGORY_BITMAP_TTL)
+
+
+# -------------------------
+# SCHEMA MIGRATIONS
+# -------------------------
+# init_db creates the original tables; each migration below runs once, in
+# order, and is recorded in schema_migrations.
+def _migrate_click_timestamp(c):
+    c.execute("ALTER TABLE users ADD COLUMN last_click_at DATETIME NULL")
+    c.execute("""
+        UPDATE users
+           SET last_click_at = CAST(REPLACE(last_category_click, 'T', ' ') AS DATETIME)
+         WHERE last_category_click IS NOT NULL AND last_category_click <> ''
+    """)
+    c.execute("ALTER TABLE users DROP COLUMN last_category_click")
+
+
+def _migrate_image_indexes(c):
+    # One row per Unsplash photo: drop duplicates, keeping the oldest row
+    c.execute("""
+        DELETE i1 FROM images i1
+          JOIN images i2 ON i1.image_id = i2.image_id AND i1.id > i2.id
+    """)
+    c.execute("""
+        ALTER TABLE images
+          ADD UNIQUE KEY unique_image_id (image_id),
+          ADD KEY idx_images_category (category_key, id)
+    """)
+    # Integer reference to images.id instead of joining on the VARCHAR id
+    c.execute("ALTER TABLE user_images ADD COLUMN image_ref INT NULL")
+    c.execute("""
+        UPDATE user_images ui
+          JOIN images i ON i.image_id = ui.image_id
+           SET ui.image_ref = i.id
+    """)
+    c.execute("ALTER TABLE user_images ADD UNIQUE KEY unique_user_image_ref (user_id, image_ref)")
+
+
+def _migrate_image_file_ids(c):
+    # Telegram file_ids of the uploaded photo/document, reused on later sends
+    c.execute("""
+        ALTER TABLE images
+          ADD COLUMN photo_file_id VARCHAR(255) NULL,
+          ADD COLUMN document_file_id VARCHAR(255) NULL
+    """)
+
+
+def _migrate_group_totals(c):
+    # Seed the running totals from what users already accumulated
+    c.execute("""
+        INSERT INTO group_totals (user_group, wallpapers_received, wallpapers_used)
+        SELECT user_group, SUM(wallpapers_received), SUM(wallpapers_used)
+          FROM users
+      GROUP BY user_group
+        ON DUPLICATE KEY UPDATE
+            wallpapers_received = VALUES(wallpapers_received),
+            wallpapers_used = VALUES(wallpapers_used)
+    """)
+
+
+def _migrate_delivery_time(c):
+    # When each image was delivered; demand signal for the prefetch planner.
+    # Existing rows have no known time and stay NULL.
+    c.execute("ALTER TABLE user_images ADD COLUMN delivered_at DATETIME NULL DEFAULT CURRENT_TIMESTAMP")
+    c.execute("UPDATE user_images SET delivered_at = NULL")
+    c.execute("ALTER TABLE user_images ADD KEY idx_user_images_delivered (delivered_at)")
+
+
+def _migrate_image_categories(c):
+    # A photo can belong to several categories; start from the one it was fetched for
+    c.execute("""
+        INSERT IGNORE INTO image_categories (category_key, image_ref)
+        SELECT category_key, id FROM images
+    """)
+
+
+def _migrate_broadcast_shards(c):
+    c.execute("""
+        ALTER TABLE broadcast_runs
+          ADD COLUMN shard INT NOT NULL DEFAULT 0,
+          ADD COLUMN shards INT NOT NULL DEFAULT 1
+    """)
+
+
+def _cyprus_date_sql(column: str) -> str:
+    # delivered_on is the Cyprus date (today_key()), delivered_at is in the
+    # session's time zone. Without MySQL's time zone tables CONVERT_TZ
+    # returns NULL; fall back to the server date then.
+    return (f"COALESCE(DATE(CONVERT_TZ({column}, @@session.time_zone, '{cyprus_tz.zone}')), "
+            f"DATE({column}))")
+
+
+def _migrate_delivery_events(c):
+    # Deliveries with a known time; older ones predate delivered_at
+    c.execute(f"""
+        INSERT INTO delivery_events (user_id, image_ref, category_key, delivered_at, delivered_on)
+        SELECT ui.user_id, ui.image_ref, i.category_key, ui.delivered_at, {_cyprus_date_sql("ui.delivered_at")}
+          FROM user_images ui
+          JOIN images i ON i.id = ui.image_ref
+         WHERE ui.delivered_at IS NOT NULL
+      ORDER BY ui.delivered_at
+    """)
+
+
+def _migrate_seed_categories(c):
+    # The categories that used to be hard-coded, in their menu order
+    rows = []
+    for main_cat, subcats in wide_categories.items():
+        rows.append(("wide", main_cat, main_cat, None, len(rows)))
+        for subcat in subcats:
+            rows.append(("wide", f"{main_cat}:{subcat}", subcat, main_cat, len(rows)))
+    for cat in narrow_categories:
+        rows.append(("narrow", cat, cat, None, len(rows)))
+    c.executemany("""
+        INSERT IGNORE INTO categories (user_group, category_key, name, parent_key, position)
+        VALUES (%s, %s, %s, %s, %s)
+    """, rows)
+
+
+def _migrate_outbox_age_index(c):
+    # Expiry and retention scan by status and age
+    c.execute("ALTER TABLE outbox ADD KEY idx_outbox_age (status, created_at)")
+
+
+def _migrate_user_images_ref_only(c):
+    # Finish the move to the integer key: image_ref is the only reference,
+    # so each delivery maintains one unique index instead of two. Rows whose
+    # photo no longer exists in images (never matched by migration 2) go.
+    c.execute("DELETE FROM user_images WHERE image_ref IS NULL")
+    c.execute("""
+        ALTER TABLE user_images
+          MODIFY image_ref INT NOT NULL,
+          DROP KEY unique_user_image,
+          DROP COLUMN image_id
+    """)
+
+
+def _migrate_lease_finished(c):
+    # Completed daily jobs stay done instead of their lease merely expiring
+    c.execute("ALTER TABLE job_leases ADD COLUMN finished_at DATETIME NULL")
+
+
+def _migrate_delivery_events_cyprus_date(c):
+    # Rows backfilled by migration 8 before it converted to the Cyprus date
+    c.execute(f"""
+        UPDATE delivery_events
+           SET delivered_on = {_cyprus_date_sql("delivered_at")}
+         WHERE delivered_at < (SELECT applied_at FROM schema_migrations WHERE version = 8)
+    """)
+
+
+def _migrate_image_categories_seq(c):
+    # A cursor over mappings, not photos: an old photo mapped to another
+    # category gets a new seq, so the ready pool's refresh picks it up
+    c.execute("""
+        ALTER TABLE image_categories
+          ADD COLUMN seq BIGINT NOT NULL AUTO_INCREMENT,
+          ADD UNIQUE KEY idx_image_categories_seq (seq)
+    """)
+
+
+def _migrate_drop_user_images_delivered(c):
+    # Demand comes from delivery_events; nothing reads this any more
+    c.execute("""
+        ALTER TABLE user_images
+          DROP KEY idx_user_images_delivered,
+          DROP COLUMN delivered_at
+    """)
+
+
+MIGRATIONS = [
+    (1, "users.last_category_click VARCHAR -> last_click_at DATETIME", _migrate_click_timestamp),
+    (2, "unique images.image_id, category index, user_images.image_ref", _migrate_image_indexes),
+    (3, "images.photo_file_id / document_file_id", _migrate_image_file_ids),
+    (4, "seed group_totals from users", _migrate_group_totals),
+    (5, "user_images.delivered_at", _migrate_delivery_time),
+    (6, "backfill image_categories from images.category_key", _migrate_image_categories),
+    (7, "broadcast_runs.shard / shards", _migrate_broadcast_shards),
+    (8, "backfill delivery_events from user_images", _migrate_delivery_events),
+    (9, "seed categories from the built-in menus", _migrate_seed_categories),
+    (10, "outbox.idx_outbox_age", _migrate_outbox_age_index),
+    (11, "user_images: drop VARCHAR image_id, image_ref NOT NULL", _migrate_user_images_ref_only),
+    (12, "job_leases.finished_at", _migrate_lease_finished),
+    (13, "delivery_events.delivered_on of backfilled rows as Cyprus date", _migrate_delivery_events_cyprus_date),
+    (14, "drop user_images.delivered_at", _migrate_drop_user_images_delivered),
+    (15, "image_categories.seq", _migrate_image_categories_seq),
+]
+
+
+def run_migrations(conn):
+    c = conn.cursor()
+    try:
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        c.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in c.fetchall()}
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {description}")
+            migrate(c)
+            c.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+    finally:
+        c.close()
+
+
+def init_db():
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            user_group VARCHAR(50) NOT NULL,
+            wallpapers_used INT NOT NULL DEFAULT 0,
+            wallpapers_received INT NOT NULL DEFAULT 0,
+            chosen_category VARCHAR(255),
+            last_category_click VARCHAR(50)
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            category_key VARCHAR(255) NOT NULL,
+            image_id VARCHAR(100) NOT NULL,
+            image_url VARCHAR(255) NOT NULL
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_images (
+            id INT PRIMARY KEY AUTO_INCREMENT,
+            user_id BIGINT NOT NULL,
+            image_id VARCHAR(100) NOT NULL,
+            UNIQUE KEY unique_user_image (user_id, image_id)
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS image_categories (
+            category_key VARCHAR(255) NOT NULL,
+            image_ref INT NOT NULL,
+            PRIMARY KEY (category_key, image_ref),
+            KEY idx_image_categories_ref (image_ref)
+        )
+        """)
+
+        # One row per delivered wallpaper; usage answers are recorded against it
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_events (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            user_id BIGINT NOT NULL,
+            image_ref INT NOT NULL,
+            category_key VARCHAR(255) NOT NULL,
+            delivered_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            delivered_on DATE NOT NULL,
+            used TINYINT(1) NULL,
+            answered_at DATETIME NULL,
+            KEY idx_delivery_events_day (delivered_on, user_id),
+            KEY idx_delivery_events_time (delivered_at, category_key),
+            KEY idx_delivery_events_user (user_id, id)
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGINT PRIMARY KEY AUTO_INCREMENT,
+            idempotency_key VARCHAR(191) NOT NULL,
+            user_id BIGINT NOT NULL,
+            message_type VARCHAR(50) NOT NULL,
+            payload TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            claimed_at DATETIME NULL,
+            sent_at DATETIME NULL,
+            last_error VARCHAR(500),
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY unique_outbox_key (idempotency_key),
+            KEY idx_outbox_due (status, next_attempt_at),
+            KEY idx_outbox_age (status, created_at)
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_runs (
+            run_key VARCHAR(191) PRIMARY KEY,
+            name VARCHAR(50) NOT NULL,
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            status VARCHAR(20) NOT NULL DEFAULT 'running',
+            started_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME NULL
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name VARCHAR(191) PRIMARY KEY,
+            owner VARCHAR(191) NOT NULL,
+            lease_until DATETIME NOT NULL,
+            acquired_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_group_stats (
+            stat_date DATE NOT NULL,
+            user_group VARCHAR(50) NOT NULL,
+            wallpapers_received INT NOT NULL DEFAULT 0,
+            wallpapers_used INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (stat_date, user_group)
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS group_totals (
+            user_group VARCHAR(50) PRIMARY KEY,
+            wallpapers_received BIGINT NOT NULL DEFAULT 0,
+            wallpapers_used BIGINT NOT NULL DEFAULT 0
+        )
+        """)
+
+        # zlib-compressed bitmap of the images.id values in user_images, per user
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS user_seen_bitmaps (
+            user_id BIGINT PRIMARY KEY,
+            bitmap MEDIUMBLOB NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+        """)
+
+        # Menu of each group; wide subcategories have key "Category:Subcategory"
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_group VARCHAR(10) NOT NULL,
+            category_key VARCHAR(255) NOT NULL,
+            name VARCHAR(64) NOT NULL,
+            parent_key VARCHAR(255) NULL,
+            position INT NOT NULL DEFAULT 0,
+            active TINYINT(1) NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY unique_group_category (user_group, category_key)
+        )
+        """)
+
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            name VARCHAR(50) PRIMARY KEY,
+            tokens DOUBLE NOT NULL,
+            updated_at DOUBLE NOT NULL
+        )
+        """)
+
+        conn.commit()
+        c.close()
+        run_migrations(conn)
+        conn.close()
+        logger.info("Database initialised (MySQL).")
+        check_query_plans()
+    except Exception as e:
+        logger.error(f"init_db error: {e}")
+        raise
+
+def get_or_create_user(user_id: int) -> Dict[str, Any]:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("""
+            SELECT user_id, user_group, wallpapers_used, wallpapers_received, chosen_category, last_click_at
+            FROM users
+            WHERE user_id = %s
+        """, (user_id,))
+        row = c.fetchone()
+        if row:
+            user = {
+                "user_id": row["user_id"],
+                "group": row["user_group"],
+                "wallpapers_used": row["wallpapers_used"],
+                "wallpapers_received": row["wallpapers_received"],
+                "chosen_category": row["chosen_category"],
+                "last_category_click": row["last_click_at"]
+            }
+        else:
+            group = random.choice(["narrow", "wide"])
+            c.execute("""
+                INSERT INTO users (user_id, user_group)
+                VALUES (%s, %s)
+            """, (user_id, group))
+            conn.commit()
+            user = {
+                "user_id": user_id,
+                "group": group,
+                "wallpapers_used": 0,
+                "wallpapers_received": 0,
+                "chosen_category": None,
+                "last_category_click": None
+            }
+        user_cache.put(user)
+        return dict(user)
+    finally:
+        c.close()
+        conn.close()
+
+USER_IMAGE_REFS_SQL = "SELECT image_ref FROM user_images WHERE user_id = %s"
+CATEGORY_REFS_SQL = "SELECT image_ref FROM image_categories WHERE category_key = %s ORDER BY image_ref"
+
+def _user_image_refs(c, user_id: int) -> List[int]:
+    c.execute(USER_IMAGE_REFS_SQL, (user_id,))
+    return [row[0] for row in c.fetchall()]
+
+def load_seen_refs(conn, user_id: int) -> SeenSet:
+    """The user's seen images; the bitmap is built from user_images and stored the first time."""
+    c = conn.cursor()
+    try:
+        c.execute("SELECT bitmap FROM user_seen_bitmaps WHERE user_id = %s", (user_id,))
+        row = c.fetchone()
+        if row:
+            return SeenSet(refs_from_bitmap(decode_bitmap(row[0])))
+        refs = _user_image_refs(c, user_id)
+        if refs:
+            # IGNORE: a concurrent delivery may have just written a newer one
+            c.execute("INSERT IGNORE INTO user_seen_bitmaps (user_id, bitmap) VALUES (%s, %s)",
+                      (user_id, encode_bitmap(bitmap_from_refs(refs))))
+            conn.commit()
+        return SeenSet(refs)
+    finally:
+        c.close()
+
+def load_user_seen_set(user_id: int) -> SeenSet:
+    """Load after a miss in seen_index.cached; the miss is not counted again."""
+    conn = get_connection()
+    try:
+        return seen_index.user(conn, user_id, count=False)
+    finally:
+        conn.close()
+
+def load_category_refs(conn, category_key: str) -> array:
+    """Ids of the category's images, ascending (the primary key order)."""
+    c = conn.cursor()
+    try:
+        c.execute(CATEGORY_REFS_SQL, (category_key,))
+        return array("I", (row[0] for row in c.fetchall()))
+    finally:
+        c.close()
+
+def _mark_seen_bitmap(c, user_id: int, image_ref: int):
+    """Set image_ref in the stored bitmap; call inside the delivery transaction."""
+    c.execute("SELECT bitmap FROM user_seen_bitmaps WHERE user_id = %s FOR UPDATE", (user_id,))
+    row = c.fetchone()
+    if row:
+        bits = decode_bitmap(row[0]) | (1 << image_ref)
+    else:
+        bits = bitmap_from_refs(_user_image_refs(c, user_id))  # already includes this delivery
+    c.execute("""
+        INSERT INTO user_seen_bitmaps (user_id, bitmap) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE bitmap = VALUES(bitmap)
+    """, (user_id, encode_bitmap(bits)))
+
+def rebuild_seen_bitmaps(batch_size: int = 1000) -> int:
+    """Recompute every user's seen bitmap from user_images. Returns the number of users."""
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM user_seen_bitmaps")
+        conn.commit()
+        after_user_id, users = -1, 0
+        while True:
+            c.execute("""
+                SELECT DISTINCT user_id FROM user_images
+                 WHERE user_id > %s
+              ORDER BY user_id
+                 LIMIT %s
+            """, (after_user_id, batch_size))
+            user_ids = [row[0] for row in c.fetchall()]
+            if not user_ids:
+                break
+            c.execute(f"""
+                SELECT user_id, image_ref FROM user_images
+                 WHERE user_id IN ({", ".join(["%s"] * len(user_ids))})
+            """, tuple(user_ids))
+            refs: Dict[int, List[int]] = {}
+            for user_id, image_ref in c.fetchall():
+                refs.setdefault(user_id, []).append(image_ref)
+            rows = [(user_id, encode_bitmap(bitmap_from_refs(r))) for user_id, r in refs.items()]
+            if rows:
+                c.executemany("""
+                    INSERT INTO user_seen_bitmaps (user_id, bitmap) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE bitmap = VALUES(bitmap)
+                """, rows)
+            conn.commit()
+            users += len(rows)
+            after_user_id = user_ids[-1]
+        seen_index.clear()
+        return users
+    finally:
+        c.close()
+        conn.close()
+
+def load_categories() -> List[Dict[str, Any]]:
+    """Active categories, for the catalog."""
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("""
+            SELECT id, user_group, category_key, name, parent_key, position
+              FROM categories
+             WHERE active = 1
+          ORDER BY id
+        """)
+        return c.fetchall()
+    finally:
+        c.close()
+        conn.close()
+
+READY_IMAGES_SQL = """
+    SELECT ic.seq, ic.category_key, i.id, i.image_id, i.image_url, i.photo_file_id, i.document_file_id
+      FROM image_categories ic
+      JOIN images i ON i.id = ic.image_ref
+     WHERE ic.seq > %s
+  ORDER BY ic.seq
+"""
+
+NEWEST_READY_IMAGES_SQL = """
+    SELECT ic.category_key, i.id, i.image_id, i.image_url, i.photo_file_id, i.document_file_id
+      FROM image_categories ic
+      JOIN images i ON i.id = ic.image_ref
+     WHERE ic.category_key = %s
+  ORDER BY ic.image_ref DESC
+     LIMIT %s
+"""
+
+def load_newest_ready_images(category_keys: List[str], per_category: int) -> tuple:
+    """
+    (the newest `per_category` image rows of each category, the highest
+    image_categories.seq). The cursor is read first, so anything mapped
+    during the load is picked up by the next refresh.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("SELECT COALESCE(MAX(seq), 0) AS max_seq FROM image_categories")
+        max_seq = c.fetchone()["max_seq"]
+        rows = []
+        for key in category_keys:
+            c.execute(NEWEST_READY_IMAGES_SQL, (key, per_category))
+            rows.extend(c.fetchall())
+        return rows, max_seq
+    finally:
+        c.close()
+        conn.close()
+
+def load_ready_images(after_seq: int) -> List[Dict[str, Any]]:
+    """Category mappings added after `after_seq`, for the ready pool."""
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute(READY_IMAGES_SQL, (after_seq,))
+        return c.fetchall()
+    finally:
+        c.close()
+        conn.close()
+
+def _candidate_images_sql(count: int) -> str:
+    # A handful of primary-key lookups, each re-checked against unique_user_image_ref
+    return f"""
+        SELECT i.id, i.image_id, i.image_url, i.photo_file_id, i.document_file_id
+          FROM images i
+         WHERE i.id IN ({", ".join(["%s"] * count)})
+           AND NOT EXISTS (
+               SELECT 1
+                 FROM user_images ui
+                WHERE ui.user_id = %s
+                  AND ui.image_ref = i.id
+           )
+      ORDER BY i.id
+    """
+
+def fetch_images_from_db(category_key: str, user_id: int, limit: int = 1) -> List[Dict[str, str]]:
+    """
+    Unseen images of a category for a user, oldest first. The candidates
+    come from seen_index; MySQL only re-checks those rows, in case another
+    replica delivered one of them since our copy of the seen set was loaded.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        rows = []
+        for _ in range(3):
+            candidates = seen_index.unseen(conn, category_key, user_id, limit)
+            if not candidates:
+                break
+            c.execute(_candidate_images_sql(len(candidates)), (*candidates, user_id))
+            rows = c.fetchall()
+            if rows:
+                break
+            # Our copies were stale: reload them and try again
+            seen_index.invalidate(user_id, category_key)
+        return [{
+            "db_id": r["id"],
+            "image_id": r["image_id"],
+            "image_url": r["image_url"],
+            "photo_file_id": r["photo_file_id"],
+            "document_file_id": r["document_file_id"]
+        } for r in rows]
+    finally:
+        c.close()
+        conn.close()
+
+def _bump_group_stats(c, user_id: int, column: str):
+    """Add one to `column` in today's and the all-time rollup of the user's group."""
+    c.execute(f"""
+        INSERT INTO daily_group_stats (stat_date, user_group, {column})
+        SELECT %s, user_group, 1 FROM users WHERE user_id = %s
+        ON DUPLICATE KEY UPDATE daily_group_stats.{column} = daily_group_stats.{column} + 1
+    """, (today_key(), user_id))
+    c.execute(f"""
+        INSERT INTO group_totals (user_group, {column})
+        SELECT user_group, 1 FROM users WHERE user_id = %s
+        ON DUPLICATE KEY UPDATE group_totals.{column} = group_totals.{column} + 1
+    """, (user_id,))
+
+def record_usage(user_id: int, used: bool, event_id: Optional[int] = None):
+    """
+    Record the user's answer to the usage question on delivery `event_id`
+    (their latest unanswered delivery for prompts sent without one). Only
+    the first answer per delivery counts; a "yes" bumps wallpapers_used.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        if event_id is not None:
+            c.execute("""
+                UPDATE delivery_events
+                   SET used = %s, answered_at = NOW()
+                 WHERE id = %s AND user_id = %s AND answered_at IS NULL
+            """, (used, event_id, user_id))
+        else:
+            c.execute("""
+                UPDATE delivery_events
+                   SET used = %s, answered_at = NOW()
+                 WHERE user_id = %s AND answered_at IS NULL
+              ORDER BY id DESC
+                 LIMIT 1
+            """, (used, user_id))
+        counted = used and c.rowcount == 1
+        if counted:
+            c.execute("""
+                UPDATE users
+                   SET wallpapers_used = wallpapers_used + 1
+                 WHERE user_id = %s
+            """, (user_id,))
+            _bump_group_stats(c, user_id, "wallpapers_used")
+        conn.commit()
+        if counted:
+            user_cache.increment(user_id, "wallpapers_used")
+    except Exception:
+        user_cache.invalidate(user_id)
+        raise
+    finally:
+        c.close()
+        conn.close()
+
+def get_group_stats(stat_date: str) -> Dict[str, Dict[str, int]]:
+    """All-time and `stat_date` counters per group: {group: {received, used, today_received, today_used}}."""
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("SELECT user_group, wallpapers_received, wallpapers_used FROM group_totals")
+        stats = {
+            r["user_group"]: {
+                "received": r["wallpapers_received"],
+                "used": r["wallpapers_used"],
+                "today_received": 0,
+                "today_used": 0,
+            }
+            for r in c.fetchall()
+        }
+        c.execute("""
+            SELECT user_group, wallpapers_received, wallpapers_used
+              FROM daily_group_stats
+             WHERE stat_date = %s
+        """, (stat_date,))
+        for r in c.fetchall():
+            group = stats.setdefault(r["user_group"], {"received": 0, "used": 0})
+            group["today_received"] = r["wallpapers_received"]
+            group["today_used"] = r["wallpapers_used"]
+        return stats
+    finally:
+        c.close()
+        conn.close()
+
+def get_stats_history(start_date: str, end_date: str) -> List[Dict[str, Any]]:
+    """Daily per-group counters between two dates (inclusive)."""
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("""
+            SELECT stat_date, user_group, wallpapers_received, wallpapers_used
+              FROM daily_group_stats
+             WHERE stat_date BETWEEN %s AND %s
+          ORDER BY stat_date, user_group
+        """, (start_date, end_date))
+        return c.fetchall()
+    finally:
+        c.close()
+        conn.close()
+
+def save_image_file_ids(image_id: str, photo_file_id: Optional[str], document_file_id: Optional[str]):
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE images
+               SET photo_file_id = COALESCE(%s, photo_file_id),
+                   document_file_id = COALESCE(%s, document_file_id)
+             WHERE image_id = %s
+        """, (photo_file_id, document_file_id, image_id))
+        conn.commit()
+    finally:
+        c.close()
+        conn.close()
+
+def category_pick_counts(since: datetime) -> Dict[str, int]:
+    """Deliveries per category since `since`, from idx_delivery_events_time."""
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            SELECT category_key, COUNT(*)
+              FROM delivery_events
+             WHERE delivered_at >= %s
+          GROUP BY category_key
+        """, (since,))
+        return dict(c.fetchall())
+    finally:
+        c.close()
+        conn.close()
+
+def get_category_snapshot(since: datetime) -> Dict[str, Dict[str, int]]:
+    """
+    Per category: stored images, deliveries since `since`, users whose
+    chosen_category it is, and the most images any recently active user
+    has already seen in it.
+    """
+    snapshot = {}
+
+    def entry(key):
+        return snapshot.setdefault(key, {"inventory": 0, "deliveries": 0, "choosers": 0, "max_seen": 0})
+
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT category_key, COUNT(*) FROM image_categories GROUP BY category_key")
+        for key, count in c.fetchall():
+            entry(key)["inventory"] = count
+        c.execute("""
+            SELECT category_key, COUNT(*)
+              FROM delivery_events
+             WHERE delivered_at >= %s
+          GROUP BY category_key
+        """, (since,))
+        for key, count in c.fetchall():
+            entry(key)["deliveries"] = count
+        c.execute("""
+            SELECT chosen_category, COUNT(*)
+              FROM users
+             WHERE chosen_category IS NOT NULL
+          GROUP BY chosen_category
+        """)
+        for key, count in c.fetchall():
+            entry(key)["choosers"] = count
+        c.execute("""
+            SELECT category_key, MAX(seen)
+              FROM (
+                    SELECT ic.category_key, ui.user_id, COUNT(*) AS seen
+                      FROM user_images ui
+                      JOIN image_categories ic ON ic.image_ref = ui.image_ref
+                     WHERE ui.user_id IN (
+                           SELECT DISTINCT user_id FROM delivery_events WHERE delivered_at >= %s
+                     )
+                  GROUP BY ic.category_key, ui.user_id
+              ) per_user
+          GROUP BY category_key
+        """, (since,))
+        for key, seen in c.fetchall():
+            entry(key)["max_seen"] = seen
+        return snapshot
+    finally:
+        c.close()
+        conn.close()
+
+def check_query_plans() -> bool:
+    """
+    EXPLAIN the hot queries and warn about full table scans.
+    Returns True if every table is accessed through an index.
+    """
+    queries = [
+        ("category ids", CATEGORY_REFS_SQL, ("Nature",)),
+        ("user seen ids", USER_IMAGE_REFS_SQL, (0,)),
+        ("ready pool warm", NEWEST_READY_IMAGES_SQL, ("Nature", 1)),
+        ("ready pool refresh", READY_IMAGES_SQL, (0,)),
+    ]
+    ok = True
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        for name, sql, params in queries:
+            c.execute("EXPLAIN " + sql, params)
+            plan = c.fetchall()
+            for row in plan:
+                logger.info(f"Plan for {name}: table={row['table']} type={row['type']} key={row['key']}")
+            full_scans = [row["table"] for row in plan if row["type"] == "ALL"]
+            if full_scans:
+                logger.warning(f"Full table scan in {name} query on: {', '.join(full_scans)}")
+                ok = False
+    finally:
+        c.close()
+        conn.close()
+    return ok
+
+def related_category_keys(category_key: str) -> List[str]:
+    """
+    Categories a photo fetched for `category_key` also belongs to: a wide
+    subcategory photo ("Nature:Mountains") also counts for the narrow
+    category of the same name ("Nature").
+    """
+    keys = [category_key]
+    if ":" in category_key:
+        main_cat = category_key.split(":", 1)[0]
+        if main_cat in catalog.narrow:
+            keys.append(main_cat)
+    return keys
+
+def add_images_to_db(category_key: str, images: List[Dict[str, str]]) -> int:
+    """
+    Bulk-ingest one Unsplash response: dedup by image_id, insert new photos
+    with one multi-row INSERT and map every photo (new or already stored)
+    to all related category keys. Returns the number of new photos.
+    """
+    unique = list({img["id"]: img for img in images}.values())
+    if not unique:
+        return 0
+    keys = related_category_keys(category_key)
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute(f"""
+            INSERT IGNORE INTO images (category_key, image_id, image_url)
+            VALUES {", ".join(["(%s, %s, %s)"] * len(unique))}
+        """, tuple(v for img in unique for v in (category_key, img["id"], img["url"])))
+        new_images = c.rowcount
+        c.execute(f"""
+            SELECT id FROM images
+             WHERE image_id IN ({", ".join(["%s"] * len(unique))})
+        """, tuple(img["id"] for img in unique))
+        refs = [row[0] for row in c.fetchall()]
+        pairs = [(key, ref) for key in keys for ref in refs]
+        c.execute(f"""
+            INSERT IGNORE INTO image_categories (category_key, image_ref)
+            VALUES {", ".join(["(%s, %s)"] * len(pairs))}
+        """, tuple(v for pair in pairs for v in pair))
+        conn.commit()
+        seen_index.add_to_category(keys, refs)
+        return new_images
+    finally:
+        c.close()
+        conn.close()
+
+def record_wallpaper_delivery(outbox_id: int, user_id: int, image_id: str, category_key: str):
+    """
+    Book a sent wallpaper in one transaction: remember the image as seen,
+    log a delivery event, bump wallpapers_received and the group rollups,
+    and mark the outbox row sent. The event and counters are only written
+    if the image was not already recorded, so a retried delivery is not
+    counted twice.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT id FROM images WHERE image_id = %s", (image_id,))
+        image_ref = c.fetchone()[0]
+        c.execute("""
+            INSERT IGNORE INTO user_images (user_id, image_ref)
+            VALUES (%s, %s)
+        """, (user_id, image_ref))
+        first_delivery = c.rowcount == 1
+        if first_delivery:
+            _mark_seen_bitmap(c, user_id, image_ref)
+            c.execute("""
+                INSERT INTO delivery_events (user_id, image_ref, category_key, delivered_on)
+                VALUES (%s, %s, %s, %s)
+            """, (user_id, image_ref, category_key, today_key()))
+            c.execute("""
+                UPDATE users
+                   SET wallpapers_received = wallpapers_received + 1
+                 WHERE user_id = %s
+            """, (user_id,))
+            _bump_group_stats(c, user_id, "wallpapers_received")
+        c.execute("UPDATE outbox SET status = 'sent', sent_at = NOW() WHERE id = %s", (outbox_id,))
+        conn.commit()
+        if first_delivery:
+            user_cache.increment(user_id, "wallpapers_received")
+            seen_index.mark_seen(user_id, image_ref)
+    except Exception:
+        user_cache.invalidate(user_id)
+        seen_index.invalidate(user_id)
+        raise
+    finally:
+        c.close()
+        conn.close()
+
+def limit_window(group: str) -> timedelta:
+    return CATEGORY_LIMIT_WINDOWS.get(group, DEFAULT_LIMIT_WINDOW)
+
+def check_category_limit(user: Dict[str, Any]) -> bool:
+    """Cheap pre-check on the cached user; claim_category_click() is authoritative."""
+    last_click = user["last_category_click"]
+    if last_click and datetime.now() - last_click < limit_window(user["group"]):
+        return False
+    return True
+
+def claim_category_click(user_id: int, category_key: str) -> Optional[datetime]:
+    """
+    Atomically take today's wallpaper for the user: a single conditional
+    UPDATE that only succeeds when the user's group window has passed, so
+    a double tap cannot pass twice. Returns the claim time, or None if the
+    user is still within the window.
+    """
+    now = datetime.now().replace(microsecond=0)
+    windows = [int(limit_window(g).total_seconds()) for g in ("narrow", "wide")]
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE users
+               SET last_click_at = %s,
+                   chosen_category = %s
+             WHERE user_id = %s
+               AND (last_click_at IS NULL
+                    OR last_click_at <= %s - INTERVAL (CASE user_group
+                                                          WHEN 'narrow' THEN %s
+                                                          WHEN 'wide' THEN %s
+                                                          ELSE %s
+                                                       END) SECOND)
+        """, (now, category_key, user_id, now, *windows, int(DEFAULT_LIMIT_WINDOW.total_seconds())))
+        conn.commit()
+        if c.rowcount != 1:
+            user_cache.invalidate(user_id)
+            return None
+        user_cache.update(user_id, last_category_click=now, chosen_category=category_key)
+        return now
+    finally:
+        c.close()
+        conn.close()
+
+def release_category_click(user_id: int, claimed_at: datetime):
+    """Give the claim back when nothing could be delivered."""
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE users SET last_click_at = NULL
+             WHERE user_id = %s AND last_click_at = %s
+        """, (user_id, claimed_at))
+        conn.commit()
+        user_cache.update(user_id, last_category_click=None)
+    finally:
+        c.close()
+        conn.close()
+
+def fetch_user_batch(after_user_id: int, batch_size: int,
+                     shard: int = 0, shards: int = 1) -> List[Dict[str, Any]]:
+    """
+    Keyset page of users ordered by user_id, starting after `after_user_id`.
+    With shards > 1 only users with user_id % shards == shard are returned.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute(f"""
+            SELECT user_id, user_group
+              FROM users
+             WHERE user_id > %s
+               {"AND MOD(user_id, %s) = %s" if shards > 1 else ""}
+          ORDER BY user_id
+             LIMIT %s
+        """, (after_user_id, *((shards, shard) if shards > 1 else ()), batch_size))
+        return c.fetchall()
+    finally:
+        c.close()
+        conn.close()
+
+def fetch_recipient_batch(day: str, after_user_id: int, batch_size: int,
+                          shard: int = 0, shards: int = 1) -> List[Dict[str, Any]]:
+    """
+    Keyset page of users who got a wallpaper on `day`, ordered by user_id,
+    each with their latest delivery of the day as `event_id`. Reads only
+    that day's slice of idx_delivery_events_day.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute(f"""
+            SELECT user_id, MAX(id) AS event_id
+              FROM delivery_events
+             WHERE delivered_on = %s
+               AND user_id > %s
+               {"AND MOD(user_id, %s) = %s" if shards > 1 else ""}
+          GROUP BY user_id
+          ORDER BY user_id
+             LIMIT %s
+        """, (day, after_user_id, *((shards, shard) if shards > 1 else ()), batch_size))
+        return c.fetchall()
+    finally:
+        c.close()
+        conn.close()
+
+def acquire_lease(name: str, ttl: int) -> bool:
+    """
+    Take or renew the lease `name` for REPLICA_ID. Succeeds if the lease is
+    free, expired or already ours, and not finished; extends it to NOW() + ttl.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        # MySQL applies the assignments left to right: once owner is switched
+        # to us, the second IF extends the lease. A finished lease never changes.
+        c.execute("""
+            INSERT INTO job_leases (name, owner, lease_until)
+            VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+            ON DUPLICATE KEY UPDATE
+                owner = IF(finished_at IS NULL AND (lease_until < NOW() OR owner = VALUES(owner)),
+                           VALUES(owner), owner),
+                acquired_at = IF(owner = VALUES(owner) AND lease_until < NOW(), NOW(), acquired_at),
+                lease_until = IF(owner = VALUES(owner) AND finished_at IS NULL, VALUES(lease_until), lease_until)
+        """, (name, REPLICA_ID, ttl))
+        c.execute("SELECT owner, finished_at FROM job_leases WHERE name = %s", (name,))
+        owner, finished_at = c.fetchone()
+        conn.commit()
+        return owner == REPLICA_ID and finished_at is None
+    finally:
+        c.close()
+        conn.close()
+
+def finish_lease(name: str):
+    """Record that the work behind `name` is done; the lease can't be taken again."""
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE job_leases SET finished_at = NOW(), lease_until = NOW()
+             WHERE name = %s AND owner = %s
+        """, (name, REPLICA_ID))
+        conn.commit()
+    finally:
+        c.close()
+        conn.close()
+
+def lease_finished(name: str) -> bool:
+    conn = get_connection()
     try:
-        conn = get_connection()
         c = conn.cursor()
+        c.execute("SELECT finished_at FROM job_leases WHERE name = %s", (name,))
+        row = c.fetchone()
+        return row is not None and row[0] is not None
+    finally:
+        c.close()
+        conn.close()
 
+def count_broadcast_senders() -> int:
+    """Replicas currently holding a broadcast shard lease."""
+    conn = get_connection()
+    try:
+        c = conn.cursor()
         c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            user_group VARCHAR(50) NOT NULL,
-            wallpapers_used INT NOT NULL DEFAULT 0,
-            wallpapers_received INT NOT NULL DEFAULT 0,
-            chosen_category VARCHAR(255),
-            last_category_click VARCHAR(50)
-        )
+            SELECT COUNT(DISTINCT owner) FROM job_leases
+             WHERE name LIKE 'broadcast:%' AND lease_until > NOW() AND finished_at IS NULL
         """)
+        return c.fetchone()[0]
+    finally:
+        c.close()
+        conn.close()
 
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS images (
-            id INT PRIMARY KEY AUTO_INCREMENT,
-            category_key VARCHAR(255) NOT NULL,
-            image_id VARCHAR(100) NOT NULL,
-            image_url VARCHAR(255) NOT NULL
-        )
-        """)
+_OUTBOX_COLUMNS = "id, idempotency_key, user_id, message_type, payload, attempts"
+
+
+def _claim_outbox_rows(c, where: str, params: tuple) -> List[Dict[str, Any]]:
+    """Lock matching rows, flip them to 'sending' and return them. Caller commits."""
+    c.execute(f"SELECT {_OUTBOX_COLUMNS} FROM outbox WHERE {where} FOR UPDATE SKIP LOCKED", params)
+    rows = c.fetchall()
+    if rows:
+        ids = [r["id"] for r in rows]
+        c.execute(f"""
+            UPDATE outbox SET status = 'sending', claimed_at = NOW()
+             WHERE id IN ({", ".join(["%s"] * len(ids))})
+        """, tuple(ids))
+    for r in rows:
+        r["payload"] = json.loads(r["payload"])
+    return rows
 
+
+def enqueue_message(idempotency_key: str, user_id: int, message_type: str,
+                    payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Store a message in the outbox and claim it for immediate delivery.
+    A message with this key that was given up on (failed, expired, or too
+    old for the outbox worker) is re-armed with fresh attempts and claimed.
+    Returns None if it is already sent or still on its way.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
         c.execute("""
-        CREATE TABLE IF NOT EXISTS user_images (
-            id INT PRIMARY KEY AUTO_INCREMENT,
-            user_id BIGINT NOT NULL,
-            image_id VARCHAR(100) NOT NULL,
-            UNIQUE KEY unique_user_image (user_id, image_id)
-        )
-        """)
+            INSERT IGNORE INTO outbox (idempotency_key, user_id, message_type, payload)
+            VALUES (%s, %s, %s, %s)
+        """, (idempotency_key, user_id, message_type, json.dumps(payload)))
+        if c.rowcount == 1:
+            rows = _claim_outbox_rows(c, "id = %s", (c.lastrowid,))
+        else:
+            rows = _claim_outbox_rows(c, """
+                idempotency_key = %s
+                AND (status IN ('failed', 'expired')
+                     OR (status = 'pending' AND created_at <= NOW() - INTERVAL %s HOUR))
+            """, (idempotency_key, OUTBOX_MAX_AGE_HOURS))
+            if rows:
+                c.execute("""
+                    UPDATE outbox SET attempts = 0, created_at = NOW(), last_error = NULL
+                     WHERE id = %s
+                """, (rows[0]["id"],))
+                rows[0]["attempts"] = 0
+        conn.commit()
+        return rows[0] if rows else None
+    finally:
+        c.close()
+        conn.close()
 
+
+def enqueue_broadcast_page(run_key: str, message_type: str, messages: List[tuple],
+                           last_user_id: int) -> List[Dict[str, Any]]:
+    """
+    Queue one page of a broadcast and advance its cursor in the same
+    transaction. `messages` are (idempotency_key, user_id, payload) tuples.
+    Returns the rows of this page that still need sending, claimed.
+    """
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.executemany("""
+            INSERT IGNORE INTO outbox (idempotency_key, user_id, message_type, payload)
+            VALUES (%s, %s, %s, %s)
+        """, [(key, user_id, message_type, json.dumps(payload)) for key, user_id, payload in messages])
+        c.execute("UPDATE broadcast_runs SET last_user_id = %s WHERE run_key = %s", (last_user_id, run_key))
+        keys = [m[0] for m in messages]
+        rows = _claim_outbox_rows(
+            c,
+            f"idempotency_key IN ({', '.join(['%s'] * len(keys))}) AND status = 'pending'",
+            tuple(keys)
+        )
         conn.commit()
+        return rows
+    finally:
         c.close()
         conn.close()
-        logger.info("Database initialised (MySQL).")
-    except Exception as e:
-        logger.error(f"init_db error: {e}")
-        raise
 
-def get_or_create_user(user_id: int) -> Dict[str, Any]:
+
+def claim_due_messages(limit: int) -> List[Dict[str, Any]]:
+    """Claim pending messages whose retry time has come, plus ones stuck in 'sending'."""
     conn = get_connection()
     try:
         c = conn.cursor(dictionary=True)
-        c.execute("""
-            SELECT user_id, user_group, wallpapers_used, wallpapers_received, chosen_category, last_category_click
-            FROM users
-            WHERE user_id = %s
-        """, (user_id,))
+        rows = _claim_outbox_rows(c, """
+            ((status = 'pending' AND next_attempt_at <= NOW())
+             OR (status = 'sending' AND claimed_at < NOW() - INTERVAL %s SECOND))
+            AND created_at > NOW() - INTERVAL %s HOUR
+            ORDER BY id LIMIT %s
+        """, (OUTBOX_STALE_AFTER, OUTBOX_MAX_AGE_HOURS, limit))
+        conn.commit()
+        return rows
+    finally:
+        c.close()
+        conn.close()
+
+
+def outbox_status(idempotency_key: str) -> Optional[str]:
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT status FROM outbox WHERE idempotency_key = %s", (idempotency_key,))
         row = c.fetchone()
-        if row:
-            return {
-                "user_id": row["user_id"],
-                "group": row["user_group"],
-                "wallpapers_used": row["wallpapers_used"],
-                "wallpapers_received": row["wallpapers_received"],
-                "chosen_category": row["chosen_category"],
-                "last_category_click": row["last_category_click"]
-            }
-        else:
-            group = random.choice(["narrow", "wide"])
+        return row[0] if row else None
+    finally:
+        c.close()
+        conn.close()
+
+
+def expire_outbox_messages() -> int:
+    """Mark undelivered messages past OUTBOX_MAX_AGE_HOURS 'expired'; the worker skips them anyway."""
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE outbox SET status = 'expired'
+             WHERE status IN ('pending', 'sending')
+               AND created_at <= NOW() - INTERVAL %s HOUR
+        """, (OUTBOX_MAX_AGE_HOURS,))
+        conn.commit()
+        return c.rowcount
+    finally:
+        c.close()
+        conn.close()
+
+
+def purge_outbox_messages(batch_size: int = 10000) -> int:
+    """Delete finished messages older than OUTBOX_RETENTION_DAYS, in small batches."""
+    conn = get_connection()
+    purged = 0
+    try:
+        c = conn.cursor()
+        while True:
             c.execute("""
-                INSERT INTO users (user_id, user_group)
-                VALUES (%s, %s)
-            """, (user_id, group))
+                DELETE FROM outbox
+                 WHERE status IN ('sent', 'failed', 'expired')
+                   AND created_at < NOW() - INTERVAL %s DAY
+                 LIMIT %s
+            """, (OUTBOX_RETENTION_DAYS, batch_size))
             conn.commit()
-            return {
-                "user_id": user_id,
-                "group": group,
-                "wallpapers_used": 0,
-                "wallpapers_received": 0,
-                "chosen_category": None,
-                "last_category_click": ""
-            }
+            purged += c.rowcount
+            if c.rowcount < batch_size:
+                return purged
+    finally:
+        c.close()
+        conn.close()
+
+
+def mark_messages_sent(outbox_ids: List[int]):
+    if not outbox_ids:
+        return
+    conn = get_connection()
+    try:
+        c = conn.cursor()
+        c.execute(f"""
+            UPDATE outbox SET status = 'sent', sent_at = NOW()
+             WHERE id IN ({", ".join(["%s"] * len(outbox_ids))})
+        """, tuple(outbox_ids))
+        conn.commit()
     finally:
         c.close()
         conn.close()
 
-def update_user(user: Dict[str, Any]):
+
+def mark_message_failed(outbox_id: int, attempts: int, error: str, permanent: bool = False):
+    """Schedule a retry with exponential backoff, or give up after OUTBOX_MAX_ATTEMPTS."""
+    attempts += 1
+    status = "failed" if permanent or attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+    delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
     conn = get_connection()
     try:
         c = conn.cursor()
         c.execute("""
-            UPDATE users
-            SET user_group = %s,
-                wallpapers_used = %s,
-                wallpapers_received = %s,
-                chosen_category = %s
-            WHERE user_id = %s
-        """, (
-            user["group"],
-            user["wallpapers_used"],
-            user["wallpapers_received"],
-            user["chosen_category"],
-            user["user_id"]
-        ))
+            UPDATE outbox
+               SET status = %s,
+                   attempts = %s,
+                   next_attempt_at = NOW() + INTERVAL %s SECOND,
+                   last_error = %s
+             WHERE id = %s
+        """, (status, attempts, delay, error[:500], outbox_id))
         conn.commit()
     finally:
         c.close()
         conn.close()
 
-def fetch_images_from_db(category_key: str, user_id: int) -> List[Dict[str, str]]:
+
+def start_broadcast_run(run_key: str, name: str, shard: int = 0, shards: int = 1) -> Dict[str, Any]:
+    """Create the run if needed and return its cursor and status."""
     conn = get_connection()
     try:
         c = conn.cursor(dictionary=True)
         c.execute("""
-        SELECT i.id, i.image_id, i.image_url
-          FROM images i
-     LEFT JOIN user_images ui
-            ON i.image_id = ui.image_id
-           AND ui.user_id = %s
-         WHERE i.category_key = %s
-           AND ui.image_id IS NULL
-        """, (user_id, category_key))
-        rows = c.fetchall()
-        return [{
-            "db_id": r["id"],
-            "image_id": r["image_id"],
-            "image_url": r["image_url"]
-        } for r in rows]
+            INSERT IGNORE INTO broadcast_runs (run_key, name, shard, shards)
+            VALUES (%s, %s, %s, %s)
+        """, (run_key, name, shard, shards))
+        conn.commit()
+        c.execute("""
+            SELECT run_key, name, last_user_id, status, shard, shards
+              FROM broadcast_runs
+             WHERE run_key = %s
+        """, (run_key,))
+        return c.fetchone()
     finally:
         c.close()
         conn.close()
 
-def add_images_to_db(category_key: str, images: List[Dict[str, str]]):
+
+def finish_broadcast_run(run_key: str):
     conn = get_connection()
     try:
         c = conn.cursor()
-        for img in images:
-            c.execute("""
-                INSERT INTO images (category_key, image_id, image_url)
-                VALUES (%s, %s, %s)
-            """, (category_key, img["id"], img["url"]))
+        c.execute("""
+            UPDATE broadcast_runs SET status = 'finished', finished_at = NOW()
+             WHERE run_key = %s
+        """, (run_key,))
         conn.commit()
     finally:
         c.close()
         conn.close()
 
-def mark_image_as_used(user_id: int, image_id: str):
+
+def unfinished_broadcast_runs(run_key_suffix: str) -> List[Dict[str, Any]]:
     conn = get_connection()
     try:
-        c = conn.cursor()
+        c = conn.cursor(dictionary=True)
         c.execute("""
-            INSERT IGNORE INTO user_images (user_id, image_id)
-            VALUES (%s, %s)
-        """, (user_id, image_id))
-        conn.commit()
+            SELECT DISTINCT name FROM broadcast_runs
+             WHERE status = 'running' AND run_key LIKE %s
+        """, (f"%:{run_key_suffix}",))
+        return c.fetchall()
     finally:
         c.close()
         conn.close()
 
-def check_category_limit(user: Dict[str, Any]) -> bool:
-    if user["last_category_click"]:
-        last_click = datetime.fromisoformat(user["last_category_click"])
-        if datetime.now() - last_click < timedelta(hours=12):
-            return False
-    return True
 
-def update_category_click(user_id: int):
+def load_rate_limit_state(name: str) -> Optional[Dict[str, float]]:
+    conn = get_connection()
+    try:
+        c = conn.cursor(dictionary=True)
+        c.execute("SELECT tokens, updated_at FROM rate_limits WHERE name = %s", (name,))
+        return c.fetchone()
+    finally:
+        c.close()
+        conn.close()
+
+def save_rate_limit_state(name: str, tokens: float, updated_at: float):
     conn = get_connection()
     try:
         c = conn.cursor()
         c.execute("""
-            UPDATE users 
-               SET last_category_click = %s 
-             WHERE user_id = %s
-        """, (datetime.now().isoformat(), user_id))
+            INSERT INTO rate_limits (name, tokens, updated_at)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE tokens = VALUES(tokens), updated_at = VALUES(updated_at)
+        """, (name, tokens, updated_at))
         conn.commit()
     finally:
         c.close()
         conn.close()
 
 
-# -------------------------
-# FETCH FROM UNSPLASH
-# -------------------------
-def fetch_images_from_unsplash(query: str, count: int = 5) -> List[Dict[str, str]]:
-    logger.info("Fetching from unsplash")
-    url = "https://api.unsplash.com/photos/random"
-    params = {
-        "query": query,
-        "client_id": UNSPLASH_ACCESS_KEY,
-        "count": count,
-        "orientation": "portrait"
-    }
-    results = []
-    try:
-        resp = requests.get(url, params=params, timeout=10)
-        if resp.status_code == 200:
-            data = resp.json()
-            for item in data:
-                results.append({
-                    "id": item["id"],
-                    "url": item["urls"]["regular"]
-                })
-        elif resp.status_code == 403:
-            logger.warning(f"Limit is exceeded! Unsplash returned {resp.status_code}: {resp.text}")
-        else:
-            logger.warning(f"Unsplash returned {resp.status_code}: {resp.text}")
-    except Exception as e:
-        logger.error(f"Error fetching from Unsplash: {e}")
-    return results
+# -------------------------
+# RATE LIMITING
+# -------------------------
+class TokenBucket:
+    """
+    Async token bucket: `capacity` tokens, refilled evenly over `period` seconds.
+
+    acquire() awaits until a token is free instead of blocking the event loop.
+    `reserve` keeps that many tokens out of reach of the caller, so low-priority
+    work (the nightly prefetch) cannot starve user clicks. When `state_name`
+    is set, the budget is stored in the rate_limits table and survives restarts.
+    """
+
+    def __init__(self, capacity: float, period: float, state_name: Optional[str] = None):
+        self.capacity = capacity
+        self.period = period
+        self.state_name = state_name
+        self.tokens = float(capacity)
+        self.updated_at = time.time()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+    def _refill(self):
+        now = time.time()
+        if now <= self.updated_at:
+            return  # paused until updated_at, see pause_until()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_rate(self, rate: float):
+        """Refill at `rate` tokens per second, with at most one second of burst (and at least one token)."""
+        self._refill()
+        self.capacity = max(rate, 1.0)
+        self.period = self.capacity / rate
+        self.tokens = min(self.tokens, self.capacity)
+
+    def available(self) -> float:
+        """Tokens free now. Read-only, so metrics can call it from another thread."""
+        return min(self.capacity, self.tokens + max(time.time() - self.updated_at, 0) * self.rate)
+
+    async def acquire(self, reserve: float = 0, timeout: Optional[float] = None) -> bool:
+        """Take one token. Returns False if none became free within `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # No lock needed: check-and-take runs without an await in between, and
+        # a sleeping low-priority waiter must not hold up high-priority callers.
+        while True:
+            self._refill()
+            if self.tokens - reserve >= 1:
+                self.tokens -= 1
+                break
+            wait = max(self.updated_at - time.time(), 0) + (1 + reserve - self.tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            await asyncio.sleep(wait)
+        await self._save()
+        return True
+
+    async def sync(self, remaining: int, limit: Optional[int] = None):
+        """Align the bucket with the quota the server reports."""
+        if limit:
+            self.capacity = limit
+        self._refill()
+        self.tokens = min(self.tokens, float(remaining))
+        await self._save()
+
+    async def pause_until(self, until: float):
+        """Empty the bucket and keep it from refilling before `until` (a time.time() value)."""
+        self.tokens = 0.0
+        self.updated_at = max(self.updated_at, until)
+        await self._save()
+
+    async def load(self):
+        if not self.state_name:
+            return
+        state = await run_db(load_rate_limit_state, self.state_name)
+        if state:
+            self.tokens = state["tokens"]
+            self.updated_at = state["updated_at"]
+            self._refill()
+            logger.info(f"Restored {self.state_name} budget: {self.tokens:.1f}/{self.capacity} tokens")
+
+    async def _save(self):
+        if not self.state_name:
+            return
+        try:
+            await run_db(save_rate_limit_state, self.state_name, self.tokens, self.updated_at)
+        except Exception as e:
+            logger.warning(f"Could not persist {self.state_name} budget: {e}")
+
+
+# Shared by the nightly prefetch and on-demand fetches
+unsplash_limiter = TokenBucket(UNSPLASH_HOURLY_LIMIT, 3600, state_name="unsplash")
+
+
+# -------------------------
+# REPLICA COORDINATION
+# -------------------------
+@asynccontextmanager
+async def hold_lease(name: str):
+    """
+    Try to take the lease `name`; yields whether we got it. While the body
+    runs the lease is renewed in the background. When the body completes
+    the lease is marked finished, so replicas firing the same job later,
+    however late, skip it. If the body raises, or the replica dies, the
+    lease expires within JOB_LEASE_TTL and can then be taken again; nothing
+    retries on its own, so callers that get False for an unfinished lease
+    must try again later (see coordinated_job and resume_broadcasts).
+    """
+    if not await run_db(acquire_lease, name, JOB_LEASE_TTL):
+        yield False
+        return
+
+    async def renew():
+        while True:
+            await asyncio.sleep(JOB_LEASE_TTL / 3)
+            try:
+                await run_db(acquire_lease, name, JOB_LEASE_TTL)
+            except Exception as e:
+                logger.warning(f"Could not renew lease {name}: {e}")
+
+    renewer = asyncio.create_task(renew())
+    try:
+        yield True
+    finally:
+        renewer.cancel()
+    try:
+        await run_db(finish_lease, name)
+    except Exception as e:
+        logger.warning(f"Could not mark lease {name} finished: {e}")
+
+
+def coordinated_job(callback):
+    """
+    Run a daily job on only one replica: whoever takes today's lease first.
+    A replica that loses to an unfinished lease checks again after the lease
+    would have expired, so the job still runs if its owner died mid-way.
+    """
+    @functools.wraps(callback)
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        # A retry keeps the day of the run it retries, even past midnight
+        day = context.job.data if context.job and context.job.data else today_key()
+        lease = f"job:{callback.__name__}:{day}"
+        async with hold_lease(lease) as owner:
+            if owner:
+                await callback(context)
+                return
+        if await run_db(lease_finished, lease):
+            logger.info(f"{callback.__name__} was done by another replica, skipping")
+            return
+        logger.info(f"{callback.__name__} is handled by another replica, checking again later")
+        context.job_queue.run_once(job, when=JOB_LEASE_TTL + 30, data=day,
+                                   name=f"{callback.__name__}:retry")
+    return job
+
+
+# -------------------------
+# FETCH FROM UNSPLASH
+# -------------------------
+class UnsplashClient:
+    """
+    Async Unsplash client with a keep-alive connection pool.
+
+    Every request takes a token from `limiter` first. The X-Ratelimit-*
+    headers of each response are fed back into the limiter, and a 403/429
+    "Rate Limit Exceeded" empties it and pauses its refill until the next
+    full hour, when the hourly quota resets, so we stop calling the API
+    instead of spending each trickled-in token on another rejected request.
+    """
+
+    def __init__(self, access_key: str, base_url: str, limiter: TokenBucket, timeout: float = 10):
+        self.access_key = access_key
+        self.base_url = base_url
+        self.limiter = limiter
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self.rate_limit: Optional[int] = None
+        self.rate_limit_remaining: Optional[int] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                headers={"Accept-Version": "v1", "Authorization": f"Client-ID {self.access_key}"},
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            )
+        return self._client
+
+    async def _read_rate_limit(self, resp: httpx.Response):
+        limit = resp.headers.get("X-Ratelimit-Limit")
+        remaining = resp.headers.get("X-Ratelimit-Remaining")
+        if limit and limit.isdigit():
+            self.rate_limit = int(limit)
+        if remaining and remaining.isdigit():
+            self.rate_limit_remaining = int(remaining)
+            await self.limiter.sync(self.rate_limit_remaining, self.rate_limit)
+
+    async def random_photos(self, query: str, count: int,
+                            reserve: float = 0, wait: Optional[float] = None) -> List[Dict[str, str]]:
+        if not await self.limiter.acquire(reserve=reserve, timeout=wait):
+            logger.warning(f"Unsplash quota exhausted, skipping request for {query}")
+            return []
+
+        params = {"query": query, "count": count, "orientation": "portrait"}
+        try:
+            resp = await self.client.get("/photos/random", params=params)
+        except httpx.HTTPError as e:
+            unsplash_requests.inc("network_error")
+            logger.error(f"Error fetching from Unsplash: {e}")
+            return []
+
+        unsplash_requests.inc(str(resp.status_code))
+        await self._read_rate_limit(resp)
+        if resp.status_code == 200:
+            return [{"id": item["id"], "url": item["urls"]["regular"]} for item in resp.json()]
+
+        if resp.status_code == 429 or (resp.status_code == 403 and "rate limit" in resp.text.lower()):
+            logger.warning(f"Limit is exceeded! Unsplash returned {resp.status_code}: {resp.text}")
+            self.rate_limit_remaining = 0
+            await self.limiter.pause_until((time.time() // 3600 + 1) * 3600)
+        elif resp.status_code in (401, 403):
+            logger.error(f"Unsplash rejected the access key ({resp.status_code}): {resp.text}")
+        else:
+            logger.warning(f"Unsplash returned {resp.status_code}: {resp.text}")
+        return []
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+unsplash = UnsplashClient(UNSPLASH_ACCESS_KEY, UNSPLASH_API_URL, unsplash_limiter)
+
+# (category_key, background) -> in-flight fetch, so concurrent misses share one request
+_inflight_fetches: Dict[tuple, asyncio.Task] = {}
+
+
+def unsplash_query_for(category_key: str) -> str:
+    """Wide keys like "Nature:Mountains" are searched by subcategory, narrow keys as-is."""
+    return category_key.split(":", 1)[-1]
+
+
+async def fetch_images_from_unsplash(query: str, count: int = UNSPLASH_MAX_COUNT,
+                                     reserve: float = 0, wait: Optional[float] = None) -> List[Dict[str, str]]:
+    logger.info("Fetching from unsplash")
+    with unsplash_seconds.time(), tracer.span("unsplash"):
+        return await unsplash.random_photos(query, count, reserve=reserve, wait=wait)
+
+
+# Yield of Unsplash requests: photos returned vs. photos we didn't have yet
+ingest_stats = {"requests": 0, "fetched": 0, "new": 0}
+
+
+async def _fetch_and_store(category_key: str, count: int, reserve: float, wait: Optional[float]) -> int:
+    fetched = await fetch_images_from_unsplash(unsplash_query_for(category_key), count=count,
+                                               reserve=reserve, wait=wait)
+    if not fetched:
+        return 0
+    new_images = await run_db(add_images_to_db, category_key, fetched)
+    ingest_stats["requests"] += 1
+    ingest_stats["fetched"] += len(fetched)
+    ingest_stats["new"] += new_images
+    logger.info(f"Unsplash {category_key}: {len(fetched)} photos, {new_images} new")
+    return len(fetched)
+
+
+async def fetch_and_store_images(category_key: str, count: int = UNSPLASH_MAX_COUNT,
+                                 background: bool = False) -> int:
+    """
+    Fetch new images for category_key from Unsplash and store them.
+    Concurrent calls for the same category wait for the same request.
+
+    Background fetches wait as long as needed for quota but leave
+    UNSPLASH_USER_RESERVE requests for users; user fetches may dip into the
+    reserve but give up after UNSPLASH_USER_WAIT seconds. So a user never
+    joins a background fetch, which could be stuck outside the reserve;
+    background callers join either kind.
+    Returns the number of images fetched.
+    """
+    task = _inflight_fetches.get((category_key, False))
+    if task is None and background:
+        task = _inflight_fetches.get((category_key, True))
+    if task is None:
+        if background:
+            coro = _fetch_and_store(category_key, count, UNSPLASH_USER_RESERVE, None)
+        else:
+            coro = _fetch_and_store(category_key, count, 0, UNSPLASH_USER_WAIT)
+        task = asyncio.create_task(coro)
+        key = (category_key, background)
+        _inflight_fetches[key] = task
+        task.add_done_callback(lambda _: _inflight_fetches.pop(key, None))
+    if background:
+        return await asyncio.shield(task)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), UNSPLASH_USER_WAIT + unsplash.timeout)
+    except asyncio.TimeoutError:
+        return 0
+
+
+# -------------------------
+# READY POOL
+# -------------------------
+class ReadyPool:
+    """
+    Image records per category, held in memory so a click picks its
+    wallpaper (lowest unseen id, via the user's seen set) without
+    querying images or calling Unsplash.
+
+    Warmed from MySQL at startup with the newest `max_per_category` images
+    of each category, and topped up by refresh() with the category mappings
+    added since the last one we have seen (image_categories.seq), which
+    also picks up the nightly prefetch, other replicas' ingests and stored
+    photos newly mapped to another category. When a pick leaves the user fewer than
+    `low_water` unseen images in the category, a background Unsplash fetch
+    refills it. Each category keeps its newest `max_per_category` images;
+    a record is dropped once no category holds it.
+    """
+
+    def __init__(self, low_water: int, max_per_category: int):
+        self.low_water = low_water
+        self.max_per_category = max_per_category
+        self._records: Dict[int, Dict[str, Any]] = {}  # images.id -> record
+        self._refs: Dict[str, int] = {}  # image_id -> images.id
+        self._categories: Dict[str, array] = {}  # category_key -> sorted images.id
+        self._holders: Dict[int, int] = {}  # images.id -> categories holding it
+        self._refills: Dict[str, asyncio.Task] = {}
+        self._background = set()  # keep fire-and-forget refreshes referenced
+        self.max_seq = 0  # last image_categories.seq loaded
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, rows: List[Dict[str, Any]], advance: bool = True):
+        """Add image rows; `advance` moves the refresh cursor (only for complete, ordered loads)."""
+        added: Dict[str, set] = {}
+        for row in rows:
+            ref = row["id"]
+            if ref not in self._records:
+                self._records[ref] = {
+                    "db_id": ref,
+                    "image_id": row["image_id"],
+                    "image_url": row["image_url"],
+                    "photo_file_id": row["photo_file_id"],
+                    "document_file_id": row["document_file_id"],
+                }
+                self._refs[row["image_id"]] = ref
+            added.setdefault(row["category_key"], set()).add(ref)
+            if advance:
+                self.max_seq = max(self.max_seq, row["seq"])
+        # One merge per category, keeping its newest max_per_category ids
+        touched = set()
+        for key, refs in added.items():
+            held = self._categories.get(key, ())
+            new = refs.difference(held)
+            if not new:
+                continue
+            merged = sorted(new.union(held))
+            trimmed = merged[:-self.max_per_category]
+            self._categories[key] = array("I", merged[-self.max_per_category:])
+            for ref in new:
+                self._holders[ref] = self._holders.get(ref, 0) + 1
+            for ref in trimmed:
+                self._holders[ref] -= 1
+            touched.update(refs, trimmed)
+        # Forget records no category holds
+        for ref in touched:
+            if not self._holders.get(ref):
+                self._holders.pop(ref, None)
+                record = self._records.pop(ref, None)
+                if record:
+                    self._refs.pop(record["image_id"], None)
+
+    def peek(self, category_key: str, seen: SeenSet) -> Optional[Dict[str, Any]]:
+        """Like pick(), without counting it as a click."""
+        unseen = lowest_unseen(self._categories.get(category_key, ()), seen, 1)
+        return self._records[unseen[0]] if unseen else None
+
+    def pick(self, category_key: str, seen: SeenSet) -> tuple:
+        """
+        (record of the lowest unseen image or None, unseen images left after
+        it). Only counts as far as `low_water`, which is all maybe_refill needs.
+        """
+        unseen = lowest_unseen(self._categories.get(category_key, ()), seen, 1 + self.low_water)
+        if not unseen:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        return dict(self._records[unseen[0]]), len(unseen) - 1
+
+    def set_file_ids(self, image_id: str, photo_file_id: Optional[str], document_file_id: Optional[str]):
+        record = self._records.get(self._refs.get(image_id))
+        if record:
+            record["photo_file_id"] = photo_file_id or record["photo_file_id"]
+            record["document_file_id"] = document_file_id or record["document_file_id"]
+
+    def depth(self) -> Dict[str, int]:
+        return {key: len(refs) for key, refs in self._categories.items()}
+
+    async def refresh(self):
+        self.add(await run_db(load_ready_images, self.max_seq))
+
+    def refresh_in_background(self):
+        async def refresh():
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Refreshing ready pool failed: {e}")
+        task = background_task("ready_refresh", refresh())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def warm(self):
+        started = time.perf_counter()
+        rows, max_seq = await run_db(load_newest_ready_images, all_category_keys(), self.max_per_category)
+        self.add(rows, advance=False)
+        self.max_seq = max(self.max_seq, max_seq)
+        logger.info(f"Ready pool warmed: {len(self._records)} images in {len(self._categories)} categories "
+                    f"in {time.perf_counter() - started:.1f}s")
+
+    def maybe_refill(self, category_key: str, remaining: int):
+        """Start a background refill of the category if the user is running low."""
+        if remaining >= self.low_water or category_key in self._refills:
+            return
+        task = background_task("ready_refill", self._refill(category_key))
+        self._refills[category_key] = task
+        task.add_done_callback(lambda _: self._refills.pop(category_key, None))
+
+    async def _refill(self, category_key: str):
+        try:
+            with ready_refill_seconds.time():
+                if await fetch_and_store_images(category_key, background=True):
+                    await self.refresh()
+        except Exception as e:
+            logger.error(f"Refilling ready pool for {category_key} failed: {e}")
+
+
+ready_pool = ReadyPool(READY_LOW_WATER, READY_POOL_MAX)
+
+
+async def seen_set(user_id: int) -> SeenSet:
+    seen = seen_index.cached(user_id)
+    if seen is None:
+        seen = await run_db(load_user_seen_set, user_id)
+    return seen
+
+
+@timed_job
+async def refresh_ready_pool(context: ContextTypes.DEFAULT_TYPE):
+    """Add images ingested since the last refresh (prefetch, other replicas)."""
+    await ready_pool.refresh()
+
+
+@timed_job
+async def reload_catalog(context: ContextTypes.DEFAULT_TYPE):
+    """Pick up category edits made in MySQL without a restart."""
+    refresh_catalog(await run_db(load_categories))
 
 
 # -------------------------
@@ -287,321 +2997,826 @@ def fetch_images_from_unsplash(query: str, count: int = 5) -> List[Dict[str, str
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"User {user_id} started")
-    user = get_or_create_user(user_id)
+    user = await run_db(get_or_create_user, user_id)
 
     await update.message.reply_text(
         "Hello! You will receive a wallpaper every day in the morning. Stay tuned!"
     )
 
 
+async def category_gone(query, context: ContextTypes.DEFAULT_TYPE):
+    """The tapped button belongs to a category that was removed since the menu was sent."""
+    await context.bot.send_message(chat_id=query.from_user.id, text="This category is no longer available.")
+
+
 async def wide_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await run_db(get_or_create_user, user_id)
     logger.info(f"User {user_id} chose wide category")
 
-    _, category = query.data.split(":", 1)  # "cat:Nature"
-    subcats = wide_categories.get(category, [])
-    if not subcats:
+    entry = catalog.decode(query.data)
+    if entry is None or entry.kind != "wide":
+        await category_gone(query, context)
+        return
+    category = entry.key
+    markup = catalog.submenu(category)
+    if markup is None:
         if query.message:
             await query.message.reply_text("No subcategories found.")
         else:
             await query.answer("No subcategories found.", show_alert=True)
         return
 
-    keyboard = [
-        [InlineKeyboardButton(s, callback_data=f"subcat:{category}:{s}")]
-        for s in subcats
-    ]
+    # Warm the likely picks while the user reads the menu
+    speculator.start(context.bot, user_id, category)
 
     if query.message:
         await query.message.reply_text(
-            f"Subcategories of {category}:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f"Subcategories of {entry.name}:",
+            reply_markup=markup
         )
     else:
-        await query.answer(f"Subcategories of {category}:", show_alert=True)
+        await query.answer(f"Subcategories of {entry.name}:", show_alert=True)
 
 
 async def wide_subcategory_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await run_db(get_or_create_user, user_id)
     logger.info(f"User {user_id} chose wide subcategory")
 
-    if not check_category_limit(user):
-        await context.bot.send_message(chat_id=user_id, text="You can get only one wallpaper a day.")
+    entry = catalog.decode(query.data)
+    if entry is None or entry.kind != "sub":
+        await category_gone(query, context)
         return
+    category_key = entry.key  # e.g. "Nature:Mountains"
+    speculator.claim(user_id, category_key)
 
-    _, main_cat, subcat = query.data.split(":", 2)  # e.g. "subcat:Nature:Mountains"
-    category_key = f"{main_cat}:{subcat}"
-    user["chosen_category"] = category_key
-    update_category_click(user_id)
-    update_user(user)
+    claimed_at = None
+    if check_category_limit(user):
+        claimed_at = await run_db(claim_category_click, user_id, category_key)
+    if claimed_at is None:
+        await context.bot.send_message(chat_id=user_id, text="You can get only one wallpaper a day.")
+        return
 
-    await send_wallpaper_to_user(user_id, category_key, context)
+    await send_wallpaper_to_user(user_id, category_key, context, claimed_at)
 
 
 async def narrow_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await run_db(get_or_create_user, user_id)
     logger.info(f"User {user_id} chose narrow category")
 
-    if not check_category_limit(user):
-        await context.bot.send_message(chat_id=user_id, text="You can only get one wallpaper a day.")
+    entry = catalog.decode(query.data)
+    if entry is None or entry.kind != "narrow":
+        await category_gone(query, context)
         return
+    category_key = entry.key
 
-    _, category = query.data.split(":", 1)
-    category_key = category
-    user["chosen_category"] = category_key
-    update_user(user)
-    update_category_click(user_id)
+    claimed_at = None
+    if check_category_limit(user):
+        claimed_at = await run_db(claim_category_click, user_id, category_key)
+    if claimed_at is None:
+        await context.bot.send_message(chat_id=user_id, text="You can only get one wallpaper a day.")
+        return
 
-    await send_wallpaper_to_user(user_id, category_key, context)
+    await send_wallpaper_to_user(user_id, category_key, context, claimed_at)
 
 
-async def send_wallpaper_to_user(user_id: int, category_key: str, context: ContextTypes.DEFAULT_TYPE):
-    # 1) Check DB for unused images in the requested category
+async def send_wallpaper_to_user(user_id: int, category_key: str, context: ContextTypes.DEFAULT_TYPE,
+                                 claimed_at: datetime):
+    # 1) Lowest unseen image from the in-memory ready pool
     logger.info(f"Trying to  send wallpapers for user {user_id}")
-    images = fetch_images_from_db(category_key, user_id)
-    if not images:
-        # 2) If none in cache, fetch from Unsplash
-        new_images = fetch_images_from_unsplash(category_key, count=5)
-        if new_images:
-            add_images_to_db(category_key, new_images)
-            # Recheck the DB
-            images = fetch_images_from_db(category_key, user_id)
-
-    if not images:
+    img, remaining = ready_pool.pick(category_key, await seen_set(user_id))
+    if img is not None:
+        ready_pool.maybe_refill(category_key, remaining)
+    else:
+        # 2) Nothing for this user in the pool: check the DB, then fetch from Unsplash
+        images = await run_db(fetch_images_from_db, category_key, user_id)
+        if not images and await fetch_and_store_images(category_key):
+            images = await run_db(fetch_images_from_db, category_key, user_id)
+        if images:
+            img = images[0]
+            ready_pool.add([{**img, "id": img["db_id"], "category_key": category_key}], advance=False)
+        ready_pool.refresh_in_background()
+
+    if img is None:
+        # Nothing delivered, so the click doesn't count against the daily limit
+        await run_db(release_category_click, user_id, claimed_at)
         await context.bot.send_message(
             chat_id=user_id,
             text=f"No new wallpapers for {category_key}, sorry."
         )
         return
 
-    # Pick the first one
-    img = images[0]
     image_id = img["image_id"]
     image_url = img["image_url"]
 
-    # Send to user
-    try:
-        await context.bot.send_photo(chat_id=user_id, photo=image_url)
-        await context.bot.send_document(chat_id=user_id, document=image_url)
-
-        # Mark the user as having received this image
-        mark_image_as_used(user_id, image_id)
-
-        # Update stats
-        user = get_or_create_user(user_id)
-        user["wallpapers_received"] += 1
-        update_user(user)
+    # Queue it in the outbox first, so a crash mid-send is retried instead of lost
+    idempotency_key = f"wallpaper:{user_id}:{today_key()}:{image_id}"
+    row = await run_db(
+        enqueue_message,
+        idempotency_key,
+        user_id,
+        "wallpaper",
+        {
+            "category_key": category_key,
+            "image_id": image_id,
+            "image_url": image_url,
+            "photo_file_id": img["photo_file_id"],
+            "document_file_id": img["document_file_id"]
+        }
+    )
+    if row is None:
+        # Already sent, or queued and the outbox worker delivers it
+        if await run_db(outbox_status, idempotency_key) == "sent":
+            text = "You already got this wallpaper today."
+        else:
+            text = "Your wallpaper is on its way."
+        await context.bot.send_message(chat_id=user_id, text=text)
+        return
 
+    # Send to user (delivery bookkeeping also marks the outbox row sent; it
+    # never raises, so only a failed send gets here)
+    try:
+        await send_outbox_message(context.bot, row)
     except Exception as e:
         logger.error(f"Error sending image to user {user_id}: {e}")
-        await context.bot.send_message(chat_id=user_id, text="Error sending wallpaper, sorry.")
+        blocked = isinstance(e, Forbidden)
+        await run_db(mark_message_failed, row["id"], row["attempts"], str(e), blocked)
+        if blocked:
+            # The user blocked the bot; telling them would fail the same way
+            return
+        if row["attempts"] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            # Given up: hand the click back so a new tap re-arms the message
+            await run_db(release_category_click, user_id, claimed_at)
+            await context.bot.send_message(chat_id=user_id, text="Error sending wallpaper, please try again later.")
+        else:
+            await context.bot.send_message(chat_id=user_id, text="Error sending wallpaper, we will retry shortly.")
 
 
 # -------------------------------------------------------
 # 3) Nightly Prefetch Job
 # -------------------------------------------------------
-async def nightly_prefetch(context: ContextTypes.DEFAULT_TYPE):
+def all_category_keys() -> List[str]:
+    return catalog.category_keys()
+
+
+def build_prefetch_plan(snapshot: Dict[str, Dict[str, int]], budget: int,
+                        per_request: int = PREFETCH_IMAGES_PER_REQUEST) -> Dict[str, Any]:
+    """
+    Decide which categories to spend `budget` Unsplash requests on.
+
+    Each user gets at most about one wallpaper a day, so a category runs dry
+    for its most active user after `runway` = inventory - max_seen days.
+    Categories with recent demand should keep PREFETCH_TARGET_DAYS of
+    runway, idle ones PREFETCH_MIN_DEPTH images. Deficits are filled for
+    categories in demand first, shortest runway and busiest first.
+
+    The projected miss rate is the share of daily demand that falls on
+    categories with less than a day of runway, before and after the plan.
     """
-    This job runs once per night, fetching new images for each category/subcategory.
-    We respect ~50 requests/hour. If we hit 48 requests in the current hour,
-    we sleep for 1 hour (blocking approach).
+    rows = []
+    for key in all_category_keys():
+        s = snapshot.get(key, {"inventory": 0, "deliveries": 0, "choosers": 0, "max_seen": 0})
+        demand = s["deliveries"] / PREFETCH_DEMAND_DAYS
+        runway = s["inventory"] - s["max_seen"]
+        if demand > 0 or s["choosers"] > 0:
+            target = max(PREFETCH_TARGET_DAYS, PREFETCH_MIN_DEPTH if s["inventory"] == 0 else 0)
+        else:
+            target = PREFETCH_MIN_DEPTH
+        rows.append({
+            "category_key": key,
+            "inventory": s["inventory"],
+            "runway": runway,
+            "demand": demand,
+            "choosers": s["choosers"],
+            "deficit": max(0, target - runway),
+            "requests": 0,
+        })
+
+    # Categories people actually pick come first
+    rows.sort(key=lambda r: (r["demand"] == 0 and r["choosers"] == 0, r["runway"], -r["demand"], -r["choosers"]))
+    remaining = budget
+    for r in rows:
+        if remaining <= 0 or r["deficit"] == 0:
+            continue
+        r["requests"] = min(remaining, math.ceil(r["deficit"] / per_request))
+        remaining -= r["requests"]
+
+    total_demand = sum(r["demand"] for r in rows)
+
+    def miss_rate(runway_of):
+        if not total_demand:
+            return 0.0
+        return sum(r["demand"] for r in rows if runway_of(r) < 1) / total_demand
+
+    return {
+        "rows": rows,
+        "budget": budget,
+        "requests": budget - remaining,
+        "miss_rate_before": miss_rate(lambda r: r["runway"]),
+        "miss_rate_after": miss_rate(lambda r: r["runway"] + r["requests"] * per_request),
+    }
+
 
-    Order of fetching:
-      1) Narrow categories (by category name)
-      2) Wide categories (by subcategory name)
+def format_prefetch_plan(plan: Dict[str, Any]) -> str:
+    lines = [f"{'category':<32} {'inv':>5} {'runway':>6} {'demand/d':>8} {'deficit':>7} {'req':>4}"]
+    for r in plan["rows"]:
+        lines.append(
+            f"{r['category_key']:<32} {r['inventory']:>5} {r['runway']:>6} "
+            f"{r['demand']:>8.2f} {r['deficit']:>7} {r['requests']:>4}"
+        )
+    lines.append(
+        f"Requests planned: {plan['requests']}/{plan['budget']}. "
+        f"Projected cache-miss rate: {plan['miss_rate_before']:.1%} -> {plan['miss_rate_after']:.1%}"
+    )
+    return "\n".join(lines)
+
+
+async def plan_prefetch(budget: int = PREFETCH_MAX_REQUESTS) -> Dict[str, Any]:
+    since = datetime.now() - timedelta(days=PREFETCH_DEMAND_DAYS)
+    snapshot = await run_db(get_category_snapshot, since)
+    return build_prefetch_plan(snapshot, budget)
+
+
+@timed_job
+@coordinated_job
+async def nightly_prefetch(context: ContextTypes.DEFAULT_TYPE):
+    """
+    This job runs once per night and tops up the categories that are about
+    to run dry (see build_prefetch_plan), spending at most
+    PREFETCH_MAX_REQUESTS Unsplash requests.
+    Requests go through the shared Unsplash token bucket: when the hourly
+    budget (minus the reserve kept for users) is spent, we await the next
+    token instead of blocking the bot.
 
-    Each category or subcategory => 1 request => fetch 5 images from Unsplash.
+    With PREFETCH_DRY_RUN=1 the plan is only logged.
     """
     logger.info("Starting nightly prefetch...")
 
-    requests_this_hour = 0
-    hour_start = datetime.now()
-
-    def check_rate_limit():
-        nonlocal requests_this_hour, hour_start
-        # If we've made 45 requests in this hour, sleep for an hour
-        if requests_this_hour >= 45:
-            logger.info("Hit 45 requests this hour, sleeping for 1 hour to respect rate limit...")
-            time.sleep(3600)  # blocks for 1 hour
-            # reset counters
-            requests_this_hour = 0
-            hour_start = datetime.now()
-        else:
-            # Also, if an hour has passed since hour_start, reset automatically
-            if (datetime.now() - hour_start) > timedelta(hours=1):
-                requests_this_hour = 0
-                hour_start = datetime.now()
+    plan = await plan_prefetch()
+    logger.info("Prefetch plan:\n" + format_prefetch_plan(plan))
+    if PREFETCH_DRY_RUN:
+        logger.info("Dry run, not fetching anything.")
+        return
 
-    # 1) Prefetch for NARROW categories (just the category name)
-    for cat in narrow_categories:
-        check_rate_limit()
-        logger.info(f"Fetching from Unsplash for narrow category: {cat}")
-        new_imgs = fetch_images_from_unsplash(cat, count=5)
-        requests_this_hour += 1  # We made one request to Unsplash
-        if new_imgs:
-            add_images_to_db(cat, new_imgs)
-
-    # 2) Prefetch for WIDE subcategories
-    for main_cat, subcats in wide_categories.items():
-        for subcat in subcats:
-            check_rate_limit()
-            cat_key = f"{main_cat}:{subcat}"
-            logger.info(f"Fetching from Unsplash for wide subcategory: {cat_key}")
-            new_imgs = fetch_images_from_unsplash(subcat, count=5)
-            requests_this_hour += 1
-            if new_imgs:
-                add_images_to_db(cat_key, new_imgs)
+    for r in plan["rows"]:
+        for _ in range(r["requests"]):
+            logger.info(f"Fetching from Unsplash for category: {r['category_key']}")
+            if not await fetch_and_store_images(r["category_key"], count=PREFETCH_IMAGES_PER_REQUEST,
+                                                background=True):
+                break
 
     logger.info("Nightly prefetch complete!")
 
 
 # -------------------------
-# DAILY JOB (MORNING DISTRIBUTION)
+# OUTBOX DELIVERY & BROADCAST
 # -------------------------
-async def morning_wallpaper_distribution(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Running morning wallpaper distribution...")
-    bot = context.bot
+def today_key() -> str:
+    return datetime.now(cyprus_tz).date().isoformat()
+
+
+# Telegram file_id reuse: hits = sent by file_id, misses = no file_id yet,
+# fallbacks = file_id rejected by Telegram and re-sent by URL
+file_id_stats = {"hits": 0, "misses": 0, "fallbacks": 0}
 
-    with sqlite3.connect("bot_data.db") as conn:
-        c = conn.cursor()
-        c.execute("SELECT user_id, user_group FROM users")
-        rows = c.fetchall()
 
-    for row in rows:
-        user_id, group = row[0], row[1]
+def file_id_hit_rate() -> float:
+    total = file_id_stats["hits"] + file_id_stats["misses"] + file_id_stats["fallbacks"]
+    return file_id_stats["hits"] / total if total else 0.0
+
+
+async def _send_media(send, chat_id: int, field: str, file_id: Optional[str], url: str):
+    """
+    Send by cached file_id if we have one, otherwise (or if Telegram rejects
+    the id) by URL. Returns (message, sent_by_url).
+    """
+    if file_id:
         try:
-            if group == "wide":
-                # Show wide categories
-                keyboard = [
-                    [InlineKeyboardButton(cat, callback_data=f"cat:{cat}")]
-                    for cat in wide_categories.keys()
-                ]
-            else:
-                # Show narrow categories
-                keyboard = [
-                    [InlineKeyboardButton(cat, callback_data=f"narrow_cat:{cat}")]
-                    for cat in narrow_categories
-                ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await bot.send_message(
-                chat_id=user_id,
-                text="Good morning! Choose one category:",
-                reply_markup=reply_markup
-            )
+            message = await send(chat_id=chat_id, **{field: file_id})
+            file_id_stats["hits"] += 1
+            return message, False
+        except BadRequest as e:
+            logger.warning(f"Cached {field} file_id rejected, falling back to URL: {e}")
+            file_id_stats["fallbacks"] += 1
+    else:
+        file_id_stats["misses"] += 1
+    return await send(chat_id=chat_id, **{field: url}), True
+
+
+async def send_wallpaper_files(bot, user_id: int, payload: Dict[str, Any]):
+    """
+    Send a wallpaper as photo + document. Telegram only downloads the image
+    from Unsplash the first time; the file_ids it returns are stored on the
+    images row and reused afterwards.
+    """
+    url = payload["image_url"]
+    photo_msg, photo_by_url = await _send_media(
+        bot.send_photo, user_id, "photo", payload.get("photo_file_id"), url
+    )
+    doc_msg, doc_by_url = await _send_media(
+        bot.send_document, user_id, "document", payload.get("document_file_id"), url
+    )
+    photo_file_id = photo_msg.photo[-1].file_id if photo_by_url and photo_msg.photo else None
+    document_file_id = doc_msg.document.file_id if doc_by_url and doc_msg.document else None
+    if photo_file_id or document_file_id:
+        try:
+            await run_db(save_image_file_ids, payload["image_id"], photo_file_id, document_file_id)
+            ready_pool.set_file_ids(payload["image_id"], photo_file_id, document_file_id)
         except Exception as e:
-            logger.error(f"Error sending morning prompt to user {user_id}: {e}")
+            logger.warning(f"Could not store file_ids for image {payload['image_id']}: {e}")
 
 
-async def nightly_usage_prompt(context: ContextTypes.DEFAULT_TYPE):
+async def book_wallpaper_delivery(row: Dict[str, Any]):
     """
-    Job that runs at 22:00 every day: asks user if they used the wallpaper.
+    Record a wallpaper that has already been sent. Never raises: a failure
+    here must not send the wallpaper again. MySQL errors (pool timeouts,
+    deadlocks) are retried with backoff for up to half of
+    OUTBOX_STALE_AFTER; after that the outbox row is at least marked sent,
+    so the outbox worker does not pick it up as a stuck send.
     """
+    payload = row["payload"]
+    deadline = time.monotonic() + OUTBOX_STALE_AFTER / 2
+    delay = 0.2
+    while True:
+        try:
+            await run_db(record_wallpaper_delivery, row["id"], row["user_id"], payload["image_id"],
+                         payload["category_key"])
+            return
+        except Error as e:
+            if time.monotonic() + delay > deadline:
+                logger.error(f"Giving up booking delivery of outbox message {row['id']}: {e}")
+                break
+            logger.warning(f"Booking delivery of outbox message {row['id']} failed ({e}), retrying")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+        except Exception as e:
+            logger.error(f"Could not book delivery of outbox message {row['id']}: {e}")
+            break
+    try:
+        await run_db(mark_messages_sent, [row["id"]])
+    except Exception as e:
+        logger.error(f"Could not mark outbox message {row['id']} sent: {e}")
 
-    logger.info("Running nightly usage prompt job...")
-    bot = context.bot
 
-    with sqlite3.connect("bot_data.db") as conn:
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM users WHERE wallpapers_received > 0")
-        rows = c.fetchall()
+async def send_outbox_message(bot, row: Dict[str, Any]):
+    """Send one outbox message. Raises TelegramError if sending fails."""
+    payload = row["payload"]
+    user_id = row["user_id"]
+    if row["message_type"] == "wallpaper":
+        await send_wallpaper_files(bot, user_id, payload)
+        await book_wallpaper_delivery(row)
+    else:
+        if payload.get("event_id"):
+            markup = usage_markup(payload["event_id"])
+        else:
+            markup = OUTBOX_MARKUPS[payload["markup"]]() if payload.get("markup") else None
+        await bot.send_message(chat_id=user_id, text=payload["text"], reply_markup=markup)
+
+
+class BroadcastStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        self.batches = 0
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"{self.name}: sent={self.sent} failed={self.failed} blocked={self.blocked} "
+                f"retried={self.retried} batches={self.batches} "
+                f"elapsed={self.elapsed:.1f}s rate={self.rate:.1f} msg/s")
+
+
+# Stats of the most recent run of each broadcast, for inspection
+last_broadcast_stats: Dict[str, BroadcastStats] = {}
+
+telegram_limiter = TokenBucket(TELEGRAM_GLOBAL_RATE, 1)
+
+
+async def share_telegram_rate():
+    """
+    Telegram's limit is per bot token, not per replica: while several
+    replicas run broadcast shards, each sends at an equal share of
+    TELEGRAM_GLOBAL_RATE.
+    """
+    try:
+        senders = await run_db(count_broadcast_senders)
+    except Exception as e:
+        logger.warning(f"Could not count broadcast senders: {e}")
+        return
+    telegram_limiter.set_rate(TELEGRAM_GLOBAL_RATE / max(senders, 1))
+
+
+class Broadcaster:
+    """
+    Delivers claimed outbox messages with bounded concurrency.
+
+    All sends share `telegram_limiter` (this replica's share of the global
+    rate, see share_telegram_rate) and keep at least
+    TELEGRAM_PER_CHAT_INTERVAL between messages to the same chat. A RetryAfter
+    from Telegram pauses every sender for the requested time, then the
+    message is retried up to BROADCAST_MAX_RETRIES times. Anything still
+    failing goes back to the outbox with exponential backoff.
+    """
+
+    def __init__(self, bot, concurrency: int = BROADCAST_CONCURRENCY, max_retries: int = BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._paused_until = 0.0
+        self._chat_last_send: Dict[int, float] = {}
+
+    async def _wait_turn(self, chat_id: int):
+        now = time.monotonic()
+        delay = max(self._paused_until - now,
+                    self._chat_last_send.get(chat_id, 0.0) + TELEGRAM_PER_CHAT_INTERVAL - now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await telegram_limiter.acquire()
+        self._chat_last_send[chat_id] = time.monotonic()
+
+    async def deliver(self, row: Dict[str, Any], stats: BroadcastStats) -> bool:
+        error = ""
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_turn(row["user_id"])
+                try:
+                    await send_outbox_message(self.bot, row)
+                    stats.sent += 1
+                    return True
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                    stats.retried += 1
+                    error = str(e)
+                    logger.warning(f"{stats.name}: flood control, pausing {retry_after}s")
+                except Forbidden as e:
+                    # User blocked the bot; retrying won't help
+                    stats.blocked += 1
+                    await run_db(mark_message_failed, row["id"], row["attempts"], str(e), True)
+                    return False
+                except Exception as e:
+                    logger.error(f"{stats.name}: error sending to user {row['user_id']}: {e}")
+                    error = str(e)
+                    break
+        stats.failed += 1
+        await run_db(mark_message_failed, row["id"], row["attempts"], error)
+        return False
+
+    async def deliver_all(self, rows: List[Dict[str, Any]], stats: BroadcastStats):
+        results = await asyncio.gather(*(self.deliver(row, stats) for row in rows))
+        # Wallpaper deliveries mark themselves sent in their own transaction
+        await run_db(mark_messages_sent, [
+            row["id"] for row, ok in zip(rows, results) if ok and row["message_type"] != "wallpaper"
+        ])
+
+    async def run(self, run: Dict[str, Any], recipients_of_day: bool,
+                  message_for: Callable[[Dict[str, Any]], Dict[str, Any]]) -> BroadcastStats:
+        """
+        Stream recipients from MySQL in keyset pages, starting after the run's
+        cursor. Each page is queued in the outbox (advancing the cursor in the
+        same transaction) and then sent, so a restart resumes mid-run.
+        With `recipients_of_day` only users who got a wallpaper that day
+        are messaged, otherwise every user.
+        """
+        name, run_key = run["name"], run["run_key"]
+        day = run_key.rsplit(":", 1)[-1]
+        stats = BroadcastStats(name)
+        last_broadcast_stats[name] = stats
+        after_user_id = run["last_user_id"]
+        while True:
+            if recipients_of_day:
+                batch = await run_db(fetch_recipient_batch, day, after_user_id, BROADCAST_BATCH_SIZE,
+                                     run["shard"], run["shards"])
+            else:
+                batch = await run_db(fetch_user_batch, after_user_id, BROADCAST_BATCH_SIZE,
+                                     run["shard"], run["shards"])
+            if not batch:
+                break
+            await share_telegram_rate()
+            after_user_id = batch[-1]["user_id"]
+            messages = [(f"{name}:{row['user_id']}:{day}", row["user_id"], message_for(row)) for row in batch]
+            rows = await run_db(enqueue_broadcast_page, run_key, name, messages, after_user_id)
+            await self.deliver_all(rows, stats)
+            stats.batches += 1
+            logger.info(f"Broadcast progress - {stats}")
+            if len(batch) < BROADCAST_BATCH_SIZE:
+                break
+        await run_db(finish_broadcast_run, run_key)
+        stats.finished = time.monotonic()
+        logger.info(f"Broadcast finished - {stats}")
+        return stats
+
+
+def morning_prompt_for(row: Dict[str, Any]) -> Dict[str, Any]:
+    if row["user_group"] == "wide":
+        # Show wide categories
+        return {"text": "Good morning! Choose one category:", "markup": "wide_categories"}
+    # Show narrow categories
+    return {"text": "Good morning! Choose one category:", "markup": "narrow_categories"}
+
+
+def usage_prompt_for(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {"text": "Did you set your new wallpaper on your phone?", "markup": "usage",
+            "event_id": row["event_id"]}
+
+
+# name -> (only users who received a wallpaper that day, payload builder)
+BROADCASTS = {
+    "morning_prompt": (False, morning_prompt_for),
+    "usage_prompt": (True, usage_prompt_for),
+}
+
+# Shards this replica is sending right now. Our own lease would let a second
+# run_broadcast (the scheduled job and a resume pass) take the same shard.
+_sending_shards: set = set()
+
 
-    for row in rows:
-        user_id = row[0]
+async def run_broadcast(bot, name: str):
+    """
+    Run today's broadcast `name`, resuming from its cursor if it was
+    interrupted. The recipients are split into BROADCAST_SHARDS user_id
+    shards; each shard is run by whichever replica takes its lease, so
+    replicas share the fan-out and no shard is sent twice.
+    """
+    recipients_of_day, message_for = BROADCASTS[name]
+    day = today_key()
+    shards = BROADCAST_SHARDS
+    # Start at a replica-specific shard so replicas don't all queue up on shard 0
+    offset = hash(REPLICA_ID) % shards
+    for i in range(shards):
+        shard = (offset + i) % shards
+        run_key = f"{name}:{day}" if shards == 1 else f"{name}#{shard}:{day}"
+        if run_key in _sending_shards:
+            continue
+        _sending_shards.add(run_key)
         try:
-            keyboard = [
-                [
-                    InlineKeyboardButton("Yes", callback_data="used:yes"),
-                    InlineKeyboardButton("No", callback_data="used:no"),
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await bot.send_message(
-                chat_id=user_id,
-                text="Did you set your new wallpaper on your phone?",
-                reply_markup=reply_markup
-            )
+            async with hold_lease(f"broadcast:{run_key}") as owner:
+                if not owner:
+                    logger.info(f"Broadcast {run_key} is run by another replica")
+                    continue
+                run = await run_db(start_broadcast_run, run_key, name, shard, shards)
+                if run["status"] == "finished":
+                    logger.info(f"Broadcast {run_key} already finished, skipping")
+                    continue
+                await Broadcaster(bot).run(run, recipients_of_day, message_for)
+        finally:
+            _sending_shards.discard(run_key)
+    # Done sending: back to the full rate for clicks and outbox retries
+    if not _sending_shards:
+        telegram_limiter.set_rate(TELEGRAM_GLOBAL_RATE)
+
+
+@timed_job
+async def outbox_worker(context: ContextTypes.DEFAULT_TYPE):
+    """Retry outbox messages whose backoff has expired or whose sender died."""
+    rows = await run_db(claim_due_messages, BROADCAST_BATCH_SIZE)
+    if rows:
+        stats = BroadcastStats("outbox_retry")
+        await Broadcaster(context.bot).deliver_all(rows, stats)
+        logger.info(f"Outbox retry - {stats}")
+
+
+@timed_job
+async def purge_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Expire messages too old to send and drop finished ones past retention."""
+    expired = await run_db(expire_outbox_messages)
+    purged = await run_db(purge_outbox_messages)
+    if expired or purged:
+        logger.info(f"Outbox: expired {expired}, purged {purged} messages")
+
+
+@timed_job
+async def resume_broadcasts(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Continue today's broadcasts that a restart interrupted. Runs repeatedly:
+    a shard whose replica died stays leased for up to JOB_LEASE_TTL, and is
+    picked up on the first pass after that.
+    """
+    for run in await run_db(unfinished_broadcast_runs, today_key()):
+        logger.info(f"Resuming broadcast {run['name']}")
+        await run_broadcast(context.bot, run["name"])
+
+
+# -------------------------
+# SPECULATIVE WARMING
+# -------------------------
+class Speculator:
+    """
+    When a wide-group user opens a category menu, warm the subcategories
+    they are most likely to tap (ranked by recent picks) before they tap:
+    load their seen set, make sure the ready pool has an unseen image,
+    fetching from Unsplash within a budget if not, and pre-upload it to
+    WARMUP_CHAT_ID so the real send goes by file_id.
+
+    Each warmed subcategory is remembered for `ttl` seconds. A tap on one
+    counts as a hit, the others (and any that expire) as waste, together
+    with the Unsplash requests and uploads they cost.
+    """
+
+    def __init__(self, top: int, ttl: float, unsplash_per_hour: int):
+        self.top = top
+        self.ttl = ttl
+        self.budget = TokenBucket(unsplash_per_hour, 3600)
+        self._pending: Dict[int, Dict[str, Any]] = {}  # user_id -> {expires_at, keys: {key: cost}}
+        self._pick_counts: Dict[str, int] = {}
+        self._pick_counts_at = 0.0
+        self._tasks = set()  # keep running warm-ups referenced
+
+    async def ranked_subcategories(self, category: str) -> List[str]:
+        if time.monotonic() - self._pick_counts_at > 3600:
+            since = datetime.now() - timedelta(days=PREFETCH_DEMAND_DAYS)
+            self._pick_counts = await run_db(category_pick_counts, since)
+            self._pick_counts_at = time.monotonic()
+        subcats = catalog.wide.get(category, [])
+        # Stable sort: ties keep the menu order
+        return sorted(subcats, key=lambda key: -self._pick_counts.get(key, 0))
+
+    def start(self, bot, user_id: int, category: str):
+        task = background_task("speculate", self._warm(bot, user_id, category))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm(self, bot, user_id: int, category: str):
+        self._expire()
+        # Registered before the first await, so a tap while we are still
+        # ranking or warming is scored against this speculation
+        self._settle(user_id, None)
+        entry = {"expires_at": time.monotonic() + self.ttl, "keys": {}}
+        self._pending[user_id] = entry
+        try:
+            subcats = (await self.ranked_subcategories(category))[:self.top]
+            if self._pending.get(user_id) is not entry:
+                return  # tapped before we knew what to warm
+            entry["keys"].update((key, {"unsplash": 0, "upload": 0}) for key in subcats)
+            seen = await seen_set(user_id)
+            for key, cost in entry["keys"].items():
+                if self._pending.get(user_id) is not entry:
+                    break  # tapped meanwhile: the rest would only be waste
+                await self._warm_key(bot, key, seen, cost)
         except Exception as e:
-            logger.error(f"Error prompting user {user_id}: {e}")
+            logger.warning(f"Speculative warming for user {user_id} failed: {e}")
+
+    async def _warm_key(self, bot, category_key: str, seen: SeenSet, cost: Dict[str, int]):
+        img = ready_pool.peek(category_key, seen)
+        if img is None:
+            if not await self.budget.acquire(timeout=0):
+                speculation_actions.inc("over_budget")
+                return
+            cost["unsplash"] += 1
+            speculation_actions.inc("fetched")
+            if await fetch_and_store_images(category_key, background=True):
+                await ready_pool.refresh()
+            img = ready_pool.peek(category_key, seen)
+            if img is None:
+                return
+        else:
+            speculation_actions.inc("pooled")
+        if WARMUP_CHAT_ID and not img["photo_file_id"]:
+            # Only spare Telegram capacity: never delay user sends or broadcasts
+            if await telegram_limiter.acquire(reserve=TELEGRAM_GLOBAL_RATE / 2, timeout=0):
+                await self._upload(bot, img)
+                cost["upload"] += 1
+                speculation_actions.inc("uploaded")
+
+    async def _upload(self, bot, img: Dict[str, Any]):
+        """Send the image to the warmup chat once so Telegram caches it; keep the file_ids."""
+        photo = await bot.send_photo(chat_id=WARMUP_CHAT_ID, photo=img["image_url"])
+        document = await bot.send_document(chat_id=WARMUP_CHAT_ID, document=img["image_url"])
+        photo_file_id = photo.photo[-1].file_id if photo.photo else None
+        document_file_id = document.document.file_id if document.document else None
+        await run_db(save_image_file_ids, img["image_id"], photo_file_id, document_file_id)
+        ready_pool.set_file_ids(img["image_id"], photo_file_id, document_file_id)
+        for message in (photo, document):
+            try:
+                await message.delete()
+            except TelegramError:
+                pass
+
+    def claim(self, user_id: int, category_key: str):
+        """The user tapped `category_key`: score their pending speculation."""
+        self._settle(user_id, category_key)
+
+    def _settle(self, user_id: int, picked: Optional[str]):
+        entry = self._pending.pop(user_id, None)
+        if entry is None or not entry["keys"]:
+            if picked is not None:
+                speculation_outcomes.inc("unwarmed")
+            return
+        if picked is not None:
+            speculation_outcomes.inc("hit" if picked in entry["keys"] else "miss")
+        for key, cost in entry["keys"].items():
+            result = "used" if key == picked else "wasted"
+            for kind, amount in cost.items():
+                if amount:
+                    speculation_cost.inc(kind, result, amount=amount)
+
+    def _expire(self):
+        now = time.monotonic()
+        for user_id in [u for u, e in self._pending.items() if e["expires_at"] < now]:
+            speculation_outcomes.inc("expired")
+            self._settle(user_id, None)
+
+
+speculator = Speculator(SPECULATE_TOP, SPECULATE_TTL, SPECULATE_UNSPLASH_PER_HOUR)
+
+
+# -------------------------
+# DAILY JOB (MORNING DISTRIBUTION)
+# -------------------------
+@timed_job
+async def morning_wallpaper_distribution(context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Running morning wallpaper distribution...")
+    await run_broadcast(context.bot, "morning_prompt")
+
+
+@timed_job
+async def nightly_usage_prompt(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Job that runs at 22:00 every day: asks user if they used the wallpaper.
+    """
+
+    logger.info("Running nightly usage prompt job...")
+    await run_broadcast(context.bot, "usage_prompt")
 
 
 async def usage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the user's response to 'did you use it?'"""
     query = update.callback_query
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    await run_db(get_or_create_user, user_id)
     await query.answer()
 
-    data = query.data  # e.g. "used:yes" or "used:no"
-    _, answer = data.split(":")
-    if answer == "yes":
-        user["wallpapers_used"] += 1
+    # "used:yes:<event_id>"; prompts sent before delivery events were "used:yes"
+    parts = query.data.split(":")
+    event_id = int(parts[2]) if len(parts) > 2 else None
+    await run_db(record_usage, user_id, parts[1] == "yes", event_id)
 
     await query.message.reply_text("Thank you for the feedback! Good night!")
 
 
+@timed_job
+@coordinated_job
 async def daily_summary(context: ContextTypes.DEFAULT_TYPE):
     """
     Gathers usage stats for 'narrow' users and 'wide' users separately,
-    plus an overall total usage rate if desired.
+    plus an overall total usage rate if desired, from the rollup tables.
     Sends or logs it to BOT_OWNER_ID.
     """
     logger.info("Generating daily summary...")
     bot = context.bot
 
-    with sqlite3.connect("bot_data.db") as conn:
-        c = conn.cursor()
+    # O(groups) lookup in the rollup tables instead of scanning users
+    stats = await run_db(get_group_stats, today_key())
+    empty = {"received": 0, "used": 0, "today_received": 0, "today_used": 0}
+    narrow = stats.get("narrow", empty)
+    wide = stats.get("wide", empty)
 
-        # Summaries for narrow group
-        c.execute("""
-            SELECT SUM(wallpapers_used), SUM(wallpapers_received)
-            FROM users
-            WHERE user_group = 'narrow'
-        """)
-        row = c.fetchone()
-        narrow_used = row[0] if row and row[0] else 0
-        narrow_received = row[1] if row and row[1] else 0
-        narrow_rate = (narrow_used / narrow_received) * 100 if narrow_received else 0
+    narrow_used = narrow["used"]
+    narrow_received = narrow["received"]
+    narrow_rate = (narrow_used / narrow_received) * 100 if narrow_received else 0
 
-        # Summaries for wide group
-        c.execute("""
-            SELECT SUM(wallpapers_used), SUM(wallpapers_received)
-            FROM users
-            WHERE user_group = 'wide'
-        """)
-        row = c.fetchone()
-        wide_used = row[0] if row and row[0] else 0
-        wide_received = row[1] if row and row[1] else 0
-        wide_rate = (wide_used / wide_received) * 100 if wide_received else 0
+    wide_used = wide["used"]
+    wide_received = wide["received"]
+    wide_rate = (wide_used / wide_received) * 100 if wide_received else 0
 
-        # Optionally, overall stats
-        c.execute("""
-            SELECT SUM(wallpapers_used), SUM(wallpapers_received)
-            FROM users
-        """)
-        row = c.fetchone()
-        total_used = row[0] if row and row[0] else 0
-        total_received = row[1] if row and row[1] else 0
-        total_rate = (total_used / total_received) * 100 if total_received else 0
+    total_used = sum(g["used"] for g in stats.values())
+    total_received = sum(g["received"] for g in stats.values())
+    total_rate = (total_used / total_received) * 100 if total_received else 0
 
     summary_text = (
         "Daily summary:\n\n"
         f"**Narrow group**:\n"
         f"  - Wallpapers Received: {narrow_received}\n"
         f"  - Wallpapers Used: {narrow_used}\n"
-        f"  - Usage Rate: {narrow_rate:.2f}%\n\n"
+        f"  - Usage Rate: {narrow_rate:.2f}%\n"
+        f"  - Today: {narrow['today_received']} received, {narrow['today_used']} used\n\n"
         f"**Wide group**:\n"
         f"  - Wallpapers Received: {wide_received}\n"
         f"  - Wallpapers Used: {wide_used}\n"
-        f"  - Usage Rate: {wide_rate:.2f}%\n\n"
+        f"  - Usage Rate: {wide_rate:.2f}%\n"
+        f"  - Today: {wide['today_received']} received, {wide['today_used']} used\n\n"
         f"**Overall**:\n"
         f"  - Total Received: {total_received}\n"
         f"  - Total Used: {total_used}\n"
@@ -617,27 +3832,287 @@ async def daily_summary(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error sending daily summary: {e}")
 
 
+# -------------------------
+# UPDATE PROCESSING
+# -------------------------
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to `concurrency` updates at once, but updates from the
+    same user strictly one after another, in arrival order.
+
+    A slow wallpaper send (cache miss, Unsplash fetch, two uploads) only
+    holds up its own user, while a double-tap waits for the first press to
+    finish instead of racing it. Per-user locks are taken *before* a
+    concurrency slot, so a user hammering a button queues on their own lock
+    without starving everyone else. Locks are refcounted and dropped once no
+    update of that user is pending.
+
+    BaseUpdateProcessor.process_update (final) takes its own slot before
+    calling do_process_update, which is the wrong order for us. So the base
+    class gets a limit that is never reached, and the user lock and our own
+    semaphore are both taken in do_process_update.
+    """
+
+    BASE_LIMIT = 65536
+
+    def __init__(self, concurrency: int):
+        super().__init__(self.BASE_LIMIT)
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+        self._locks: Dict[int, List] = {}  # user_id -> [lock, updates holding or waiting]
+        self.pending = 0  # updates received but not started yet
+        self.max_pending = 0
+        self.started = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent_waits = deque(maxlen=1000)
+
+    @staticmethod
+    def _key(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    @asynccontextmanager
+    async def _user_lock(self, key: Optional[int]):
+        if key is None:
+            yield
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        received = time.monotonic()
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        started = False
+        try:
+            async with self._user_lock(self._key(update)):
+                async with self._slots:
+                    started = True
+                    self.pending -= 1
+                    self.in_flight += 1
+                    self._record_wait(time.monotonic() - received)
+                    try:
+                        with update_seconds.time(), tracer.span(update_span_name(update)):
+                            await coroutine
+                    finally:
+                        self.in_flight -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                self.pending -= 1
+                # Never awaited (e.g. cancelled on shutdown); close it to avoid a warning
+                coroutine.close()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _record_wait(self, wait: float):
+        self.started += 1
+        update_wait_seconds.observe(wait)
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._recent_waits.append(wait)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._recent_waits)
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "locked_users": len(self._locks),
+            "processed": self.processed,
+            "avg_wait": self.total_wait / self.started if self.started else 0.0,
+            "p99_wait": waits[int(len(waits) * 0.99)] if waits else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+update_processor = KeyedUpdateProcessor(UPDATE_CONCURRENCY)
+
+
+# -------------------------
+# WEBHOOK SERVER
+# -------------------------
+# Gauges over the stats the components already keep, read on each scrape
+metrics.gauge("wallpapers_db_pool", "DB pool connections and counters", pool_stats, "state")
+metrics.gauge("wallpapers_user_cache_size", "Users in the in-process cache", lambda: user_cache.stats()["size"])
+metrics.gauge("wallpapers_user_cache_hit_rate", "User cache hit rate", lambda: user_cache.stats()["hit_rate"])
+metrics.gauge("wallpapers_seen_index", "Seen-image sets cached in memory",
+              lambda: {k: v for k, v in seen_index.stats().items() if k in ("users", "bytes", "categories")},
+              "kind")
+metrics.gauge("wallpapers_seen_index_hit_rate", "Seen set cache hit rate", lambda: seen_index.stats()["hit_rate"])
+metrics.gauge("wallpapers_ready_pool_depth", "Images held in the ready pool per category",
+              ready_pool.depth, "category")
+metrics.gauge("wallpapers_ready_pool_picks", "Ready pool picks: hit or no unseen image in the pool",
+              lambda: {"hit": ready_pool.hits, "miss": ready_pool.misses}, "outcome")
+metrics.gauge("wallpapers_file_id_sends", "Wallpaper sends by file_id reuse outcome", lambda: file_id_stats, "outcome")
+metrics.gauge("wallpapers_file_id_hit_rate", "Share of wallpaper sends that reused a file_id", file_id_hit_rate)
+metrics.gauge("wallpapers_unsplash_ingest", "Unsplash requests, photos fetched and new photos", lambda: ingest_stats, "kind")
+metrics.gauge("wallpapers_unsplash_tokens", "Unsplash requests left in our local budget", unsplash_limiter.available)
+metrics.gauge("wallpapers_unsplash_quota_remaining", "X-Ratelimit-Remaining of the last Unsplash response",
+              lambda: unsplash.rate_limit_remaining)
+metrics.gauge("wallpapers_updates", "Update processing: in flight, pending, locked users",
+              lambda: {k: v for k, v in update_processor.stats().items() if k in ("in_flight", "pending", "locked_users")},
+              "state")
+
+
+def metrics_response() -> Response:
+    return Response(metrics.expose(), mimetype="text/plain; version=0.0.4")
+
+
+def create_metrics_app() -> Flask:
+    """Metrics-only app for polling mode, where there is no webhook server."""
+    app = Flask(__name__)
+    app.add_url_rule("/metrics", "metrics", metrics_response)
+    return app
+
+
+def create_webhook_app(application: Application, loop: asyncio.AbstractEventLoop) -> Flask:
+    """
+    Flask app receiving Telegram updates. Requests are checked against
+    WEBHOOK_SECRET (X-Telegram-Bot-Api-Secret-Token) and handed to the
+    bot's bounded update queue on the event loop. When the queue (plus
+    updates waiting for a processing slot) is full we answer 503 and
+    Telegram redelivers the update later.
+    """
+    app = Flask(__name__)
+
+    async def enqueue(update: Update) -> bool:
+        # The queue itself drains instantly into processing tasks, so count those too
+        if application.update_queue.qsize() + update_processor.pending >= WEBHOOK_QUEUE_SIZE:
+            return False
+        try:
+            application.update_queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    @app.post(WEBHOOK_PATH)
+    def telegram_webhook():
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+            abort(403)
+        data = request.get_json(silent=True)
+        if not data:
+            abort(400)
+        update = Update.de_json(data, application.bot)
+        if not asyncio.run_coroutine_threadsafe(enqueue(update), loop).result(timeout=5):
+            logger.warning("Update queue is full, asking Telegram to retry")
+            abort(503)
+        return "", 200
+
+    app.add_url_rule("/metrics", "metrics", metrics_response)
+
+    @app.get("/healthz")
+    def healthz():
+        healthy = application.running
+        return jsonify({
+            "status": "ok" if healthy else "stopping",
+            "update_queue": application.update_queue.qsize(),
+            "update_queue_size": WEBHOOK_QUEUE_SIZE,
+            "updates": update_processor.stats(),
+            "db_pool": pool_stats(),
+        }), 200 if healthy else 503
+
+    return app
+
+
+def check_webhook_config():
+    """Without a URL set_webhook gets just the path; without a secret every update is rejected."""
+    missing = [name for name, value in (("WEBHOOK_URL", WEBHOOK_URL), ("WEBHOOK_SECRET", WEBHOOK_SECRET)) if not value]
+    if missing:
+        raise RuntimeError(f"BOT_MODE=webhook requires {' and '.join(missing)} to be set")
+
+
+async def serve_webhook(application: Application):
+    """Run the bot behind the Flask webhook endpoint until SIGINT/SIGTERM."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    server = make_server(WEBHOOK_LISTEN, WEBHOOK_PORT, create_webhook_app(application, loop), threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, name="webhook", daemon=True)
+
+    # post_init/post_shutdown only run inside run_polling/run_webhook, so call them here
+    async with application:
+        await on_startup(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await application.start()
+        server_thread.start()
+        logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await stop.wait()
+        finally:
+            server.shutdown()
+            await application.stop()
+            await on_shutdown(application)
+
+
 # -------------------------
 # Main
 # -------------------------
-def main():
-    # 1) init DB
-    init_db()
+async def on_startup(application: Application):
+    refresh_catalog(await run_db(load_categories))
+    await unsplash_limiter.load()
+    await ready_pool.warm()
+
 
-    # 2) build app
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+async def on_shutdown(application: Application):
+    await unsplash.close()
+    _db_executor.shutdown(wait=False)
 
-    # 3) Register command/callback handlers
+
+def build_application() -> Application:
+    """The bot with its handlers and daily jobs registered (shared with bench/)."""
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .base_file_url(TELEGRAM_FILE_URL)
+        .update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE))
+        .concurrent_updates(update_processor)
+        .request(TelegramRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        # Updates arrive through the Flask endpoint, not getUpdates
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Register command/callback handlers
     application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CallbackQueryHandler(wide_category_callback, pattern=r"^cat:"))
-    application.add_handler(CallbackQueryHandler(wide_subcategory_callback, pattern=r"^subcat:"))
+    application.add_handler(CommandHandler("profile", profile_command))
+    # Catalog buttons ("c1w12"), plus the pre-catalog "cat:Nature" style still on old messages
+    application.add_handler(CallbackQueryHandler(wide_category_callback, pattern=r"^(c1w|cat:)"))
+    application.add_handler(CallbackQueryHandler(wide_subcategory_callback, pattern=r"^(c1s|subcat:)"))
 
     # For narrow group
-    application.add_handler(CallbackQueryHandler(narrow_category_callback, pattern=r"^narrow_cat:"))
+    application.add_handler(CallbackQueryHandler(narrow_category_callback, pattern=r"^(c1n|narrow_cat:)"))
 
     application.add_handler(CallbackQueryHandler(usage_callback, pattern=r"^used:"))
 
-    # 4) schedule jobs
+    # Schedule jobs
 
     job_queue: JobQueue = application.job_queue
     job_queue.run_daily(
@@ -665,7 +4140,43 @@ def main():
         days=(0, 1, 2, 3, 4, 5, 6)
     )
 
-    application.run_polling()
+    # Outbox retries and broadcasts interrupted by a restart
+    job_queue.run_repeating(outbox_worker, interval=OUTBOX_POLL_INTERVAL, first=OUTBOX_POLL_INTERVAL)
+    job_queue.run_repeating(purge_outbox, interval=OUTBOX_PURGE_INTERVAL, first=OUTBOX_PURGE_INTERVAL)
+    job_queue.run_repeating(resume_broadcasts, interval=JOB_LEASE_TTL / 2, first=10)
+    job_queue.run_repeating(refresh_ready_pool, interval=READY_REFRESH_INTERVAL, first=READY_REFRESH_INTERVAL)
+    job_queue.run_repeating(reload_catalog, interval=CATALOG_RELOAD_INTERVAL, first=CATALOG_RELOAD_INTERVAL)
+    return application
+
+
+def main():
+    if BOT_MODE == "webhook":
+        check_webhook_config()
+
+    # 1) init DB
+    init_db()
+
+    if "--plan-prefetch" in sys.argv:
+        # Dry run: print tonight's prefetch plan and exit
+        refresh_catalog(load_categories())
+        print(format_prefetch_plan(asyncio.run(plan_prefetch())))
+        return
+
+    if "--rebuild-seen-bitmaps" in sys.argv:
+        print(f"Rebuilt seen bitmaps of {rebuild_seen_bitmaps()} users")
+        return
+
+    # 2) build app, register handlers and jobs
+    application = build_application()
+
+    if BOT_MODE == "webhook":
+        asyncio.run(serve_webhook(application))
+    else:
+        if METRICS_PORT:
+            server = make_server(WEBHOOK_LISTEN, METRICS_PORT, create_metrics_app(), threaded=True)
+            threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+            logger.info(f"Metrics on {WEBHOOK_LISTEN}:{METRICS_PORT}/metrics")
+        application.run_polling()
 
 
 if __name__ == "__main__":